@@ -1,6 +1,7 @@
 from fastapi import APIRouter
 
-from api.routes import request_types
+from api.routes import metrics, request_types
 
 router = APIRouter()
-router.include_router(request_types.router, tags=["similarity"], prefix="/v1")
\ No newline at end of file
+router.include_router(request_types.router, tags=["similarity"], prefix="/v1")
+router.include_router(metrics.router, tags=["monitoring"], prefix="/v1")
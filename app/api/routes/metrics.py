@@ -0,0 +1,18 @@
+from fastapi import APIRouter, Request
+
+from app.models.airbnb_listing_db import get_listing_cache
+
+router = APIRouter()
+
+@router.get(
+    "/metrics",
+    response_model=dict,
+    name="metrics:get",
+)
+async def get_metrics(request: Request):
+    cache = get_listing_cache()
+    encoder = getattr(request.app.state, 'query_encoder', None)
+    return {
+        "cache": cache.stats() if cache else None,
+        "encoder": encoder.batcher.stats() if encoder else None,
+    }
@@ -1,23 +1,87 @@
 import json
+from typing import List, Optional, Tuple
 
 import joblib
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Query, Request
+from pydantic import BaseModel, Field
 from app.models.airbnb_listing_db import AirbnbListingDB
+from app.core.database.listing_features import filtered_neighbours, rerank_neighbours
+from core.config import (
+    FILTER_PREFILTER_ROWS,
+    MAX_BATCH_SIZE,
+    MAX_NEARBY_RADIUS_M,
+    MAX_SIMILAR_LISTINGS,
+    RERANK_CANDIDATES,
+    RERANK_GEO_SCALE_M,
+)
 
 router = APIRouter()
 
+class BatchGetRequest(BaseModel):
+    ids: List[int] = Field(..., min_length=1, max_length=MAX_BATCH_SIZE)
+    fields: Optional[List[str]] = None
+
+class BatchSimilarRequest(BaseModel):
+    ids: List[int] = Field(..., min_length=1, max_length=MAX_BATCH_SIZE)
+    k: int = Field(20, ge=1, le=MAX_SIMILAR_LISTINGS)
+
+class ListingQuery(BaseModel):
+    property_type: Optional[str] = None
+    room_type: Optional[str] = None
+    price: Optional[float] = None
+    bathrooms_text: Optional[str] = None
+    bedrooms: Optional[float] = None
+    beds: Optional[float] = None
+    accommodates: Optional[int] = None
+    neighbourhood_cleansed: Optional[str] = None
+    neighborhood_overview: Optional[str] = None
+    description: Optional[str] = None
+    review_scores_rating: Optional[float] = None
+    review_scores_cleanliness: Optional[float] = None
+    review_scores_checkin: Optional[float] = None
+    review_scores_communication: Optional[float] = None
+    review_scores_location: Optional[float] = None
+    review_scores_value: Optional[float] = None
+
+class SimilarSearchRequest(BaseModel):
+    text: Optional[str] = Field(None, max_length=10000)
+    listing: Optional[ListingQuery] = None
+    k: int = Field(20, ge=1, le=MAX_SIMILAR_LISTINGS)
+    expand: bool = False
+    fields: Optional[List[str]] = None
+
+async def expand_neighbours(request: Request, neighbours: List[Tuple[int, float]],
+                            fields: Optional[List[str]], key: str = "score") -> List[dict]:
+    '''
+    Hydrates every neighbour with one batched query, keeping the rank order. `key` names
+    the neighbour's score in the response
+    '''
+    try:
+        listings = await request.app.state.db_executor.run(
+            AirbnbListingDB.get_by_ids, [id for id, _ in neighbours], fields
+        )
+    except ValueError as err:
+        raise HTTPException(status_code=400, detail=str(err))
+    properties = {listing.id: listing.properties for listing in listings}
+    return [
+        {"id": id, key: score, **properties.get(id, {})}
+        for id, score in neighbours
+    ]
+
 @router.get(
     "/listing/{listing_id}",
     response_model=dict,
     name="listing:get-by-id",
 )
-async def get_listing(listing_id: int):
+async def get_listing(request: Request, listing_id: int):
     try:
-        listing = AirbnbListingDB.get_by_id(listing_id)
+        listing = await request.app.state.db_executor.run(AirbnbListingDB.get_by_id, listing_id)
         if listing:
             return {"id": listing.id, **listing.properties}
         else:
             raise HTTPException(status_code=404, detail="Listing not found")
+    except HTTPException:
+        raise
     except Exception as err:
         raise HTTPException(status_code=500, detail=f"Exception: {err}")
 
@@ -26,14 +90,205 @@ async def get_listing(listing_id: int):
     response_model=list,
     name="listing:get-similar",
 )
-async def get_similar_listings(listing_id: int):
+async def get_similar_listings(
+    request: Request,
+    listing_id: int,
+    k: int = Query(20, ge=1, le=MAX_SIMILAR_LISTINGS),
+    expand: bool = False,
+    fields: Optional[str] = Query(None, description="Comma separated listing columns to return when expand=true"),
+    min_price: Optional[float] = Query(None, ge=0),
+    max_price: Optional[float] = Query(None, ge=0),
+    room_type: Optional[str] = Query(None, description="Comma separated room types to keep"),
+    radius_km: Optional[float] = Query(None, gt=0, description="Only listings within this distance of the listing"),
+    embedding_weight: float = Query(1.0, ge=0, description="Hybrid ranking weight of the cosine similarity"),
+    numeric_weight: float = Query(0.0, ge=0, description="Hybrid ranking weight of price, bedrooms, accommodates and rating"),
+    geo_weight: float = Query(0.0, ge=0, description="Hybrid ranking weight of the distance to the listing"),
+):
+    try:
+        # One build's index and features for the whole request, even if a reload swaps them
+        search = request.app.state.vector_search
+        if search is None:
+            raise HTTPException(status_code=503, detail="Similarity index not loaded")
+        # With several markets, the listing is searched within its own
+        search = search.for_listing(listing_id)
+        if search is None:
+            raise HTTPException(status_code=404, detail="Listing not found")
+        index, features = search.index, search.features
+
+        room_types = [value.strip() for value in room_type.split(',') if value.strip()] if room_type else None
+        filtered = any(value is not None for value in (min_price, max_price, room_types, radius_km))
+        hybrid = numeric_weight > 0 or geo_weight > 0
+        if (filtered or hybrid) and features is None:
+            raise HTTPException(status_code=503, detail="Listing features not loaded, filters and hybrid ranking are unavailable")
+
+        # Hybrid ranking re-scores a larger candidate set than it returns
+        candidates = max(k, RERANK_CANDIDATES) if hybrid else k
+        if filtered:
+            # Nearest neighbours among the listings matching the filters
+            neighbours = await request.app.state.db_executor.run(
+                filtered_neighbours, index, features, listing_id, candidates,
+                min_price, max_price, room_types, radius_km * 1000 if radius_km else None, FILTER_PREFILTER_ROWS,
+            )
+        else:
+            # Nearest neighbours by cosine similarity of the average embedding
+            neighbours = await request.app.state.db_executor.run(index.search_by_id, listing_id, candidates)
+
+        if neighbours is None:
+            raise HTTPException(status_code=404, detail="Listing not found")
+
+        if hybrid:
+            neighbours = await request.app.state.db_executor.run(
+                rerank_neighbours, features, listing_id, neighbours, k,
+                embedding_weight, numeric_weight, geo_weight, RERANK_GEO_SCALE_M,
+            )
+
+        if not expand:
+            return [{"id": id, "score": score} for id, score in neighbours]
+
+        field_list = [field.strip() for field in fields.split(',') if field.strip()] if fields else None
+        return await expand_neighbours(request, neighbours, field_list)
+    except HTTPException:
+        raise
+    except Exception as err:
+        raise HTTPException(status_code=500, detail=f"Exception: {err}")
+
+@router.get(
+    "/listing/{listing_id}/nearby",
+    response_model=list,
+    name="listing:get-nearby",
+)
+async def get_nearby_listings(
+    request: Request,
+    listing_id: int,
+    radius_m: float = Query(1000, gt=0, le=MAX_NEARBY_RADIUS_M),
+    k: int = Query(20, ge=1, le=MAX_SIMILAR_LISTINGS),
+    expand: bool = False,
+    fields: Optional[str] = Query(None, description="Comma separated listing columns to return when expand=true"),
+):
+    try:
+        search = request.app.state.vector_search
+        if search is None:
+            raise HTTPException(status_code=503, detail="Listing features not loaded")
+        search = search.for_listing(listing_id)
+        if search is None:
+            raise HTTPException(status_code=404, detail="Listing not found")
+        features = search.features
+        if features is None:
+            raise HTTPException(status_code=503, detail="Listing features not loaded")
+
+        # Closest listings by haversine distance, read from the coordinates grid
+        neighbours = await request.app.state.db_executor.run(features.nearby, listing_id, radius_m, k)
+        if neighbours is None:
+            raise HTTPException(status_code=404, detail="Listing not found")
+
+        if not expand:
+            return [{"id": id, "distance_m": distance} for id, distance in neighbours]
+
+        field_list = [field.strip() for field in fields.split(',') if field.strip()] if fields else None
+        return await expand_neighbours(request, neighbours, field_list, key="distance_m")
+    except HTTPException:
+        raise
+    except Exception as err:
+        raise HTTPException(status_code=500, detail=f"Exception: {err}")
+
+@router.get(
+    "/listing/{listing_id}/cluster",
+    response_model=list,
+    name="listing:get-cluster",
+)
+async def get_cluster_listings(
+    request: Request,
+    listing_id: int,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=MAX_BATCH_SIZE),
+):
     try:
-        # Get similar listings directly using the class method
-        similar_listings = AirbnbListingDB.get_listings_in_cluster(listing_id)
-        
-        if not similar_listings:
+        # Get a page of the listings sharing the DBSCAN/HDBSCAN cluster
+        cluster_listings = await request.app.state.db_executor.run(
+            AirbnbListingDB.get_listings_in_cluster, listing_id, skip, limit
+        )
+
+        if not cluster_listings:
             raise HTTPException(status_code=404, detail="No similar listings found")
-        
-        return similar_listings
+
+        return cluster_listings
+    except HTTPException:
+        raise
+    except Exception as err:
+        raise HTTPException(status_code=500, detail=f"Exception: {err}")
+
+
+@router.post(
+    "/listings:batchGet",
+    response_model=dict,
+    name="listing:batch-get",
+)
+async def batch_get_listings(request: Request, body: BatchGetRequest):
+    try:
+        # One json_each join for the whole batch
+        listings = await request.app.state.db_executor.run(
+            AirbnbListingDB.get_by_ids, body.ids, body.fields
+        )
+        found = {listing.id: listing for listing in listings}
+        return {
+            "listings": [{"id": listing.id, **listing.properties} for listing in found.values()],
+            "missing": [id for id in dict.fromkeys(body.ids) if id not in found],
+        }
+    except ValueError as err:
+        raise HTTPException(status_code=400, detail=str(err))
+    except Exception as err:
+        raise HTTPException(status_code=500, detail=f"Exception: {err}")
+
+@router.post(
+    "/listings/similar:batch",
+    response_model=dict,
+    name="listing:batch-similar",
+)
+async def batch_similar_listings(request: Request, body: BatchSimilarRequest):
+    try:
+        search = request.app.state.vector_search
+        if search is None:
+            raise HTTPException(status_code=503, detail="Similarity index not loaded")
+
+        # One batched search for every requested listing (per market with several)
+        ids = list(dict.fromkeys(body.ids))
+        results = await request.app.state.db_executor.run(search.search_by_ids, ids, body.k)
+        return {
+            "results": [
+                {"id": id, "similar": [{"id": n, "score": score} for n, score in results[id]]}
+                for id in ids if id in results
+            ],
+            "missing": [id for id in ids if id not in results],
+        }
+    except HTTPException:
+        raise
     except Exception as err:
-        raise HTTPException(status_code=500, detail=f"Exception: {err}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Exception: {err}")
+
+@router.post(
+    "/similar/search",
+    response_model=list,
+    name="similar:search",
+)
+async def search_similar_listings(request: Request, body: SimilarSearchRequest):
+    try:
+        encoder = request.app.state.query_encoder
+        search = request.app.state.vector_search
+        if encoder is None or search is None or search.dimension is None:
+            raise HTTPException(status_code=503, detail="Query-by-text search not available")
+
+        # The free text and the templated listing fields, encoded with the build's model
+        attributes = body.listing.model_dump(exclude_none=True) if body.listing else {}
+        try:
+            query = await encoder.encode(body.text, attributes)
+        except ValueError as err:
+            raise HTTPException(status_code=400, detail=str(err))
+
+        neighbours = await request.app.state.db_executor.run(search.search_by_vector, query, body.k)
+        if not body.expand:
+            return [{"id": id, "score": score} for id, score in neighbours]
+        return await expand_neighbours(request, neighbours, body.fields)
+    except HTTPException:
+        raise
+    except Exception as err:
+        raise HTTPException(status_code=500, detail=f"Exception: {err}")
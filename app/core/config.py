@@ -1,3 +1,4 @@
+import os
 import sys
 import logging
 
@@ -15,6 +16,44 @@ MAX_CONNECTIONS_COUNT: int = config("MAX_CONNECTIONS_COUNT", cast=int, default=1
 MIN_CONNECTIONS_COUNT: int = config("MIN_CONNECTIONS_COUNT", cast=int, default=10)
 
 PROJECT_NAME: str = config("PROJECT_NAME", default="airbnb_similar_listings")
+DB_PATH: str = config("DB_PATH", default="airbnb.db")
+VECTOR_STORE_PATH: str = config(
+    "VECTOR_STORE_PATH", default=os.path.splitext(DB_PATH)[0] + "_vectors"
+)
+DB_EXECUTOR_WORKERS: int = config("DB_EXECUTOR_WORKERS", cast=int, default=MAX_CONNECTIONS_COUNT)
+# Connections opened up front per market when DB_PATH is a multi-market index
+MARKET_MIN_CONNECTIONS: int = config("MARKET_MIN_CONNECTIONS", cast=int, default=1)
+SQLITE_MMAP_SIZE: int = config("SQLITE_MMAP_SIZE", cast=int, default=268435456)
+SQLITE_CACHE_SIZE_KIB: int = config("SQLITE_CACHE_SIZE_KIB", cast=int, default=65536)
+CACHE_ENABLED: bool = config("CACHE_ENABLED", cast=bool, default=True)
+CACHE_MAX_ENTRIES: int = config("CACHE_MAX_ENTRIES", cast=int, default=50000)
+CACHE_MAX_BYTES: int = config("CACHE_MAX_BYTES", cast=int, default=128 * 1024 * 1024)
+CACHE_TTL_SECONDS: float = config("CACHE_TTL_SECONDS", cast=float, default=0)
+CACHE_VERSION_CHECK_SECONDS: float = config("CACHE_VERSION_CHECK_SECONDS", cast=float, default=30)
+# sqlite or snapshot
+LISTING_BACKEND: str = config("LISTING_BACKEND", default="sqlite")
+SNAPSHOT_PATH: str = config("SNAPSHOT_PATH", default=os.path.splitext(DB_PATH)[0] + ".snapshot")
+VECTOR_INDEX_BACKEND: str = config("VECTOR_INDEX_BACKEND", default="ivf")
+IVF_NPROBE: int = config("IVF_NPROBE", cast=int, default=16)
+# How often the dataset version is polled to reopen the vector store after a refresh, 0 never
+VECTOR_RELOAD_CHECK_SECONDS: float = config("VECTOR_RELOAD_CHECK_SECONDS", cast=float, default=30)
+MAX_SIMILAR_LISTINGS: int = config("MAX_SIMILAR_LISTINGS", cast=int, default=100)
+MAX_BATCH_SIZE: int = config("MAX_BATCH_SIZE", cast=int, default=1000)
+# Filtered /similar: at most this many matching listings are scored exactly instead of
+# filtering the index's candidates
+FILTER_PREFILTER_ROWS: int = config("FILTER_PREFILTER_ROWS", cast=int, default=10000)
+# Hybrid /similar ranking: nearest neighbours re-scored per request, and the distance in
+# metres at which the geo similarity falls to 1/e
+RERANK_CANDIDATES: int = config("RERANK_CANDIDATES", cast=int, default=200)
+RERANK_GEO_SCALE_M: float = config("RERANK_GEO_SCALE_M", cast=float, default=2000)
+# Largest radius accepted by /nearby, in metres
+MAX_NEARBY_RADIUS_M: float = config("MAX_NEARBY_RADIUS_M", cast=float, default=50000)
+# Query-by-text search: the build's model, loaded at startup, and the most texts per forward pass
+QUERY_ENCODER_ENABLED: bool = config("QUERY_ENCODER_ENABLED", cast=bool, default=True)
+SENTENCE_TRANSFORMER_MODEL: str = config("SENTENCE_TRANSFORMER_MODEL", default="distilbert-base-nli-stsb-mean-tokens")
+QUERY_BATCH_SIZE: int = config("QUERY_BATCH_SIZE", cast=int, default=64)
+# How long a batch waits for more searches after its first one
+QUERY_BATCH_WAIT_MS: float = config("QUERY_BATCH_WAIT_MS", cast=float, default=5)
 # logging configuration
 LOGGING_LEVEL = logging.DEBUG if DEBUG else logging.INFO
 logging.basicConfig(
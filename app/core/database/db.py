@@ -4,30 +4,160 @@ import os, sys
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
 sys.path.append(project_root)
 
+import queue
 import sqlite3
+import threading
+import time
 from contextlib import contextmanager
-from typing import List, Dict, Any, Generator
-from app.core.database.listing_schema_utils import LISTING_TABLE_SCHEMA
+from typing import List, Dict, Any, Generator, Optional, Tuple
+from app.core.database.listing_schema_utils import LISTING_TABLE_SCHEMA, CLUSTER_MEMBER_TABLE_SCHEMA
 from dotenv import load_dotenv
 
 load_dotenv()
 
-class AirbnbDatabase:
-    def __init__(self, db_path: str = os.getenv('DB_PATH')):
+def dict_factory(cursor: sqlite3.Cursor, row: tuple) -> Dict[str, Any]:
+    return dict(zip([col[0] for col in cursor.description], row))
+
+class ConnectionPool:
+    """
+    Bounded pool of persistent SQLite connections.
+
+    Connections are opened once and leased to one thread at a time, so requests stop paying
+    the connect cost and keep a warm page cache. Idle connections are reused most recently
+    used first.
+
+    When the file at `db_path` is swapped for a rebuilt one (checked at most every
+    `replace_check_seconds`), connections to the old file are retired as they are released
+    and new ones open the new file.
+    """
+    def __init__(self, db_path: str, min_size: int = 1, max_size: int = 10, read_only: bool = True,
+                 mmap_size: int = 268435456, cache_size_kib: int = 65536, timeout: float = 30.0,
+                 replace_check_seconds: float = 1.0):
+        if min_size > max_size:
+            raise ValueError("min_size must not exceed max_size")
         self.db_path = db_path
+        self.read_only = read_only
+        self.mmap_size = mmap_size
+        self.cache_size_kib = cache_size_kib
+        self.timeout = timeout
+        self.replace_check_seconds = replace_check_seconds
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._idle = queue.LifoQueue()
+        self._all: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._file = self._file_id()
+        self._checked_at = time.monotonic()
+        self._generation = 0
+        self._generations: Dict[sqlite3.Connection, int] = {}
+        for _ in range(min_size):
+            self._idle.put(self._connect())
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.row_factory = dict_factory
+        if self.read_only:
+            conn.execute('PRAGMA query_only = ON')
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        conn.execute(f'PRAGMA cache_size = {-int(self.cache_size_kib)}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        with self._lock:
+            self._all.append(conn)
+            self._generations[conn] = self._generation
+        return conn
+
+    def _file_id(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.db_path)
+        except OSError:
+            return None
+        return stat.st_dev, stat.st_ino
+
+    def _check_replaced(self) -> None:
+        now = time.monotonic()
+        if now - self._checked_at < self.replace_check_seconds:
+            return
+        self._checked_at = now
+        file = self._file_id()
+        if file is None or file == self._file:
+            return
+        with self._lock:
+            self._file = file
+            self._generation += 1
+        while True:
+            try:
+                self._retire(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+    def _retire(self, conn: sqlite3.Connection) -> None:
+        with self._lock:
+            if conn in self._all:
+                self._all.remove(conn)
+            self._generations.pop(conn, None)
+        conn.close()
+
+    @contextmanager
+    def connection(self) -> Generator[sqlite3.Connection, None, None]:
+        """
+        Leases a connection, blocking while all `max_size` connections are in use
+        """
+        if self._closed:
+            raise RuntimeError("Connection pool is closed")
+        if not self._slots.acquire(timeout=self.timeout):
+            raise TimeoutError(f"No database connection available after {self.timeout}s")
+        try:
+            self._check_replaced()
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                if self._generations.get(conn) == self._generation:
+                    self._idle.put(conn)
+                else:
+                    self._retire(conn)
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        """Close every connection opened by the pool."""
+        self._closed = True
+        with self._lock:
+            for conn in self._all:
+                conn.close()
+            self._all = []
+            self._generations = {}
+        self._idle = queue.LifoQueue()
+
+class AirbnbDatabase:
+    def __init__(self, db_path: Optional[str] = None, pool: Optional[ConnectionPool] = None):
+        # DB_PATH is read when the database is created rather than at import, so a build
+        # worker can point it at its market
+        self.db_path = db_path or os.getenv('DB_PATH')
+        self.pool = pool
 
     @contextmanager
     def get_connection(self) -> Generator[sqlite3.Connection, None, None]:
         """
-        Returns a connection to the database
+        Returns a connection to the database, leased from the pool when there is one
         """
+        if self.pool:
+            with self.pool.connection() as conn:
+                yield conn
+            return
+
         conn = sqlite3.connect(self.db_path)
-        conn.row_factory = lambda c, r: dict(zip([col[0] for col in c.description], r))
+        conn.row_factory = dict_factory
         try:
             yield conn
         finally:
             conn.close()
-            self.connection = None
 
     def execute_query(self, query: str, params: Dict[str, Any] = None) -> None:
         """
@@ -66,22 +196,111 @@ class AirbnbDatabase:
             return cursor.fetchmany(size)
 
     def close_connection(self) -> None:
-        """Close the database connection if it's open."""
-        if self.connection:
-            self.connection.close()
-            self.connection = None
+        """Close the pooled connections if there are any."""
+        if self.pool:
+            self.pool.close()
+            self.pool = None
+
+_default_database: Optional[AirbnbDatabase] = None
+
+def set_default_database(db: Optional[AirbnbDatabase]) -> None:
+    """
+    Sets the database used when callers don't pass one, e.g. the pooled database created
+    at app startup
+    """
+    global _default_database
+    _default_database = db
+
+def get_default_database() -> AirbnbDatabase:
+    return _default_database or AirbnbDatabase()
+
+def migrate_cluster_membership(db: AirbnbDatabase) -> bool:
+    """
+    Moves a database built with the comma separated `listing.listings_in_cluster` column to
+    the `cluster_member` table. Members keep the order they had in the old string.
+    Returns False when there was nothing to migrate.
+    """
+    columns = [row['name'] for row in db.fetch_data("PRAGMA table_info(listing)")]
+    if 'listings_in_cluster' not in columns:
+        return False
+
+    print('Migrating listings_in_cluster to cluster_member...')
+    with db.get_connection() as conn:
+        conn.execute(f'CREATE TABLE IF NOT EXISTS cluster_member ({CLUSTER_MEMBER_TABLE_SCHEMA}) WITHOUT ROWID')
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_cluster_member_listing ON cluster_member (listing_id)')
+        conn.execute('DELETE FROM cluster_member')
+        conn.execute('''
+            INSERT INTO cluster_member (cluster_id, listing_id, rank)
+            SELECT listing.cluster, member.value, member.key
+            FROM (SELECT MIN(id) AS id FROM listing WHERE cluster != -1 GROUP BY cluster) AS representative
+            JOIN listing ON listing.id = representative.id,
+                json_each('[' || listing.listings_in_cluster || ']') AS member
+        ''')
+        # Requires SQLite 3.35+
+        conn.execute('ALTER TABLE listing DROP COLUMN listings_in_cluster')
+        conn.commit()
+        conn.execute('VACUUM')
+    print("Migration finished.")
+    return True
+
+def migrate_content_hash(db: AirbnbDatabase) -> bool:
+    """
+    Adds the `listing.content_hash` column incremental refreshes compare against. Listings
+    loaded before it existed have no hash and are reprocessed by the next refresh.
+    """
+    columns = [row['name'] for row in db.fetch_data("PRAGMA table_info(listing)")]
+    if not columns or 'content_hash' in columns:
+        return False
+    db.execute_query('ALTER TABLE listing ADD COLUMN content_hash TEXT')
+    return True
+
+def enable_wal(db_path: str) -> None:
+    """
+    Puts the database file in WAL mode, so the API's read-only connections never block on a
+    writer. The mode is stored in the file, the pool itself never writes it.
+    """
+    conn = sqlite3.connect(db_path, timeout=30.0)
+    try:
+        conn.execute('PRAGMA journal_mode = WAL')
+    finally:
+        conn.close()
+
+def replace_database(source: str, target: str) -> None:
+    """
+    Atomically moves the database file built at `source` over `target`, in WAL mode.
+    Connections that already have the old file open keep reading it until they are closed.
+    The old file's WAL is checkpointed and truncated first, so connections opening the new
+    file can't replay stale frames from it.
+    """
+    enable_wal(source)
+    if os.path.exists(target):
+        conn = sqlite3.connect(target, timeout=30.0)
+        try:
+            busy, _, _ = conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        finally:
+            conn.close()
+        if busy:
+            raise RuntimeError(f"Could not checkpoint {target}, {source} was left in place")
+    os.replace(source, target)
 
 def initialize_database():
     # For now, we'll use a local path to the database, will update to be generic (env variable)
     if os.path.exists(os.getenv('DB_PATH')):
         print("Database already exists.")
+        # Databases built before `make create_db` enabled WAL are switched here
+        enable_wal(os.getenv('DB_PATH'))
+        migrate_cluster_membership(AirbnbDatabase())
+        migrate_content_hash(AirbnbDatabase())
         return
 
     os.makedirs(os.path.dirname(os.getenv('DB_PATH')), exist_ok=True)
     print('Initializing database...')
 
+    enable_wal(os.getenv('DB_PATH'))
     db = AirbnbDatabase()
     db.execute_query(f'CREATE TABLE IF NOT EXISTS listing ({LISTING_TABLE_SCHEMA})')
+    db.execute_query(f'CREATE TABLE IF NOT EXISTS cluster_member ({CLUSTER_MEMBER_TABLE_SCHEMA}) WITHOUT ROWID')
+    db.execute_query('CREATE INDEX IF NOT EXISTS idx_cluster_member_listing ON cluster_member (listing_id)')
     print("Database initialized successfully.")
 
 if __name__ == '__main__':
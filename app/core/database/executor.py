@@ -0,0 +1,31 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+
+class DatabaseExecutor:
+    """
+    Runs blocking sqlite3 and vector index calls on a dedicated thread pool, so `async def`
+    routes can await them instead of serializing every request on the event loop thread.
+
+    The pool size should match the connection pool size: a worker never waits on a
+    connection, and the semaphore bounds how much work is queued at once.
+    """
+    def __init__(self, max_workers: int = 10):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='db')
+        self._semaphore = None
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        '''
+        Awaits `fn(*args, **kwargs)` on one of the executor threads
+        '''
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        async with self._semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
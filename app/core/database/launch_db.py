@@ -1,11 +1,30 @@
-from db import AirbnbDatabase, initialize_database
-from listing_schema_utils import load_listings, Listing
-from typing import List
+from db import AirbnbDatabase, initialize_database, replace_database
+from listing_schema_utils import Listing, CLUSTER_MEMBER_TABLE_SCHEMA, DATASET_META_TABLE_SCHEMA
+from vector_store import VectorStore, META_FILE, save_vector_store, update_vector_store, default_vector_store_path
+from vector_index import IVFIndex, IVF_META_FILE, build_ivf_index, update_ivf_index, load_vector_index
+from snapshot import build_snapshot, default_snapshot_path
+from listing_features import (
+    FEATURE_COLUMNS, FEATURES_META_FILE, ListingFeatures, save_listing_features, update_listing_features,
+)
+from markets import parse_markets, market_db_path, write_market_index
+from typing import Dict, List, Optional, Iterator, Tuple
+import os
+import shutil
+import click
+import sqlite3
+import typing
+import multiprocessing
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import json
+import uuid
+from datetime import datetime, timezone
+import numpy as np
 import pandas as pd
-from ml.data.make_dataset import clean_data as make_dataset_clean_data
-from ml.features.build_features import pipeline as generate_embeddings
-from ml.model.similarity_search import pipeline_clustering
+import torch
+from ml.features.build_features import pipeline as generate_embeddings, EMBEDDING_FIELDS, load_model
+from ml.model.similarity_search import build_cluster_members, assign_clusters, load_clustering_model, predict_clusters
+from ml.pipeline import STAGES, run_pipeline, load_clean_listings
 
 CREATE_TABLE_QUERY = '''
 CREATE TABLE IF NOT EXISTS listing (
@@ -37,89 +56,419 @@ CREATE TABLE IF NOT EXISTS listing (
     property_outline TEXT NOT NULL,
     high_level_overview TEXT NOT NULL,
     cluster INTEGER NOT NULL,
-    listings_in_cluster TEXT NOT NULL
+    content_hash TEXT
 )
 '''
 
-INSERT_LISTING_QUERY = '''
-INSERT OR REPLACE INTO listing (
-    id, listing_url, price, property_type, room_type, bathrooms_text,
-    bedrooms, beds, accommodates, latitude, longitude, neighborhood_overview,
-    neighbourhood_group_cleansed, neighbourhood_cleansed, description,
-    amenities, host_about, review_scores_rating, review_scores_cleanliness,
-    review_scores_checkin, review_scores_communication, review_scores_location,
-    review_scores_value, number_of_reviews, description_summary, property_outline, high_level_overview,
-    cluster, listings_in_cluster
-) VALUES (
-    :id, :listing_url, :price, :property_type, :room_type, :bathrooms_text,
-    :bedrooms, :beds, :accommodates, :latitude, :longitude, :neighborhood_overview,
-    :neighbourhood_group_cleansed, :neighbourhood_cleansed, :description,
-    :amenities, :host_about, :review_scores_rating, :review_scores_cleanliness,
-    :review_scores_checkin, :review_scores_communication, :review_scores_location,
-    :review_scores_value, :number_of_reviews, :description_summary, :property_outline, :high_level_overview,
-    :cluster, :listings_in_cluster
-)
+CREATE_CLUSTER_MEMBER_TABLE_QUERY = f'''
+CREATE TABLE IF NOT EXISTS cluster_member ({CLUSTER_MEMBER_TABLE_SCHEMA}) WITHOUT ROWID
+'''
+
+CREATE_CLUSTER_MEMBER_INDEX_QUERY = '''
+CREATE INDEX IF NOT EXISTS idx_cluster_member_listing ON cluster_member (listing_id)
 '''
 
+CREATE_DATASET_META_TABLE_QUERY = f'''
+CREATE TABLE IF NOT EXISTS dataset_meta ({DATASET_META_TABLE_SCHEMA})
+'''
+
+INSERT_CLUSTER_MEMBER_QUERY = '''
+INSERT INTO cluster_member (cluster_id, listing_id, rank) VALUES (?, ?, ?)
+'''
+
+# The public Listing fields plus the internal hash of the source CSV row, compared by
+# incremental refreshes and never served by the API
+LISTING_COLUMNS = list(Listing.model_fields) + ['content_hash']
+
+INSERT_LISTING_QUERY = f'''
+INSERT OR REPLACE INTO listing ({', '.join(LISTING_COLUMNS)}) VALUES ({', '.join('?' * len(LISTING_COLUMNS))})
+'''
+
+# Created once a bulk load has inserted every row
+CREATE_INDEX_QUERIES = [CREATE_CLUSTER_MEMBER_INDEX_QUERY]
+
+def listing_rows(df: pd.DataFrame) -> Iterator[Tuple]:
+    '''
+    Streams the listings as tuples in LISTING_COLUMNS order, straight from the DataFrame
+    columns and sorted by id: every column is converted to the Python type of its Listing
+    field once (content_hash stays a string), with missing values as None
+    '''
+    order = np.argsort(df['id'].to_numpy(), kind='stable')
+    columns = []
+    for name in LISTING_COLUMNS:
+        if name not in df:
+            columns.append([None] * len(df))
+            continue
+        values = df[name].iloc[order].reset_index(drop=True)
+        annotation = Listing.model_fields[name].annotation if name in Listing.model_fields else str
+        kind = next((t for t in typing.get_args(annotation) if t is not type(None)), annotation)
+        if kind is int:
+            values = values.map(int, na_action='ignore')
+        elif kind is float:
+            values = values.astype(float)
+        columns.append(values.astype(object).where(values.notna(), None).tolist())
+    return zip(*columns)
+
+# Paths that default to siblings of DB_PATH, cleared in market workers so every market gets its own
+MARKET_DERIVED_PATHS = [
+    'VECTOR_STORE_PATH', 'SNAPSHOT_PATH', 'ARTIFACTS_PATH', 'CLUSTERING_MODEL_PATH', 'EMBEDDING_CACHE_PATH',
+]
+
 class LaunchDB:
-    def __init__(self):
-        self.db = AirbnbDatabase()
+    def __init__(self, db_path: Optional[str] = None):
+        self.db = AirbnbDatabase(db_path)
+        self.dataset_version = None
+        # Set once the listing features of the new dataset version are written
+        self.features_saved = False
 
-    def clean_data(self, df):
-        # Use the clean_data function from make_dataset
-        return make_dataset_clean_data(df)
+    def load_data(self, start_stage: str = 'clean'):
+        # Clean, embed and cluster the NYC listings. Every stage writes a Parquet artifact,
+        # so a load can resume from any stage without redoing the earlier ones
+        df, embeddings, average_embeddings = run_pipeline(os.getenv('NYC_CSV_FILEPATH'), start=start_stage)
 
-    def load_data(self):
-        # Initialize the database
-        initialize_database()
+        # Persist the embeddings so the API can memory map them, and index them for k-NN
+        self._save_vector_store(df, embeddings, average_embeddings)
+        self._build_vector_index()
+
+        # Write the listings, cluster membership and a new dataset version stamp into a fresh
+        # file and swap it in, the API keeps serving the previous file until then
+        self._bulk_load(df, build_cluster_members(df, average_embeddings))
 
-        # Create the listing table
+    def load_data_incremental(self):
+        '''
+        Applies only what changed since the last load: listings whose source row hash differs
+        (or that are new) are embedded and assigned to the cluster of their nearest clustered
+        neighbour (or predicted by the persisted HDBSCAN model when USE_PCA is on), deleted
+        listings are dropped, and the database changes are committed in
+        one transaction. Falls back to a full load when there is nothing to diff against or when
+        more than INCREMENTAL_MAX_CHURN of the listings changed.
+
+        The updated vector store, IVF index and listing features are written next to the current
+        ones and only moved into place once the database changes are committed, so a failed
+        refresh leaves both as they were.
+        '''
+        initialize_database()
         self._create_listing_table()
 
-        # Load NYC listings
-        df = load_listings()
+        store_path = default_vector_store_path()
+        staging_path = store_path + '.next'
+        if os.path.exists(staging_path):
+            # Left behind by a refresh that failed before committing
+            shutil.rmtree(staging_path)
+        existing = pd.DataFrame(
+            self.db.fetch_data("SELECT id, cluster, content_hash FROM listing"),
+            columns=['id', 'cluster', 'content_hash'],
+        )
+        if existing.empty or not VectorStore.exists(store_path):
+            print("Nothing to diff against, running a full load.")
+            self.load_data()
+            return
+
+        df = load_clean_listings(os.getenv('NYC_CSV_FILEPATH'))
+        previous_hashes = existing.set_index('id')['content_hash']
+        deleted_ids = np.setdiff1d(existing['id'].to_numpy(), df['id'].to_numpy())
+        changed = df['content_hash'].to_numpy() != df['id'].map(previous_hashes).to_numpy()
+        df = df[changed].copy()
+        print(f"{len(df)} new or changed listings, {len(deleted_ids)} deleted.")
+        if df.empty and len(deleted_ids) == 0:
+            return
+        # Past this share, attaching listings to existing clusters drifts too far from a re-clustering
+        if (len(df) + len(deleted_ids)) / len(existing) > float(os.getenv('INCREMENTAL_MAX_CHURN', 0.5)):
+            print("Too many changes for an incremental refresh, running a full load.")
+            self.load_data()
+            return
+
+        previous_store = VectorStore(store_path)
+        previous_index = IVFIndex(previous_store) if IVFIndex.exists(store_path) else None
+        if len(df):
+            df, embeddings, average_embeddings = generate_embeddings(df, compact_cache=False)
+        else:
+            dim = previous_store.meta['matrices']['average']['dim']
+            embeddings = np.empty((0, len(EMBEDDING_FIELDS), dim), dtype=np.float32)
+            average_embeddings = np.empty((0, dim), dtype=np.float32)
 
-        # Clean the data
-        df = self.clean_data(df)
+        # Replace the changed rows of the vector store and re-bucket them in the index
+        matrices = {'average': average_embeddings}
+        for i, field in enumerate(EMBEDDING_FIELDS):
+            matrices[field] = embeddings[:, i, :]
+        update_vector_store(store_path, df['id'].to_numpy(), matrices, deleted_ids, out_path=staging_path)
+        store = VectorStore(staging_path)
+        if previous_index:
+            update_ivf_index(store, previous_index, df['id'].to_numpy())
+        else:
+            self._build_vector_index(store)
 
-        # Generate embeddings
-        df = generate_embeddings(df)
+        # Assign new and changed listings to the clusters of the listings that stayed
+        unchanged = existing[~existing['id'].isin(np.concatenate([df['id'].to_numpy(), deleted_ids]))]
+        clustering_model = load_clustering_model() if os.getenv('USE_PCA') == 'True' else None
+        if clustering_model:
+            # HDBSCAN: project into the fitted PCA space and predict without a refit
+            df['cluster'] = predict_clusters(clustering_model, average_embeddings).astype(int)
+        else:
+            clusters = dict(zip(unchanged['id'].tolist(), unchanged['cluster'].tolist()))
+            index = load_vector_index(store, backend=os.getenv('VECTOR_INDEX_BACKEND', 'ivf'))
+            neighbours = index.search_by_ids(df['id'].tolist(), int(os.getenv('INCREMENTAL_NEIGHBOURS', 10)))
+            labels = assign_clusters(neighbours, clusters, float(os.getenv('SIMILARITY_THRESHOLD')))
+            df['cluster'] = df['id'].map(labels).fillna(-1).astype(int)
 
-        # Call the pipeline_clustering function after generating embeddings
-        df = pipeline_clustering(df)
+        # Re-rank the members of every cluster that gained or lost a listing
+        touched = existing[~existing['id'].isin(unchanged['id'])]['cluster'].tolist() + df['cluster'].tolist()
+        affected = sorted({int(cluster) for cluster in touched if cluster != -1})
+        members = pd.concat([
+            unchanged[unchanged['cluster'].isin(affected)][['id', 'cluster']],
+            df[df['cluster'].isin(affected)][['id', 'cluster']],
+        ])
+        member_vectors = np.asarray(store.matrix('average')[store.rows(members['id'].to_numpy())], dtype=np.float32)
+        cluster_members = build_cluster_members(members, member_vectors)
 
-        # Convert DataFrame to list of ListingItem objects
-        listings = []
-        for _, row in df.iterrows():
-            listing = Listing(**row.to_dict())
-            listings.append(listing)
+        self.dataset_version = self._new_dataset_version()
+        if ListingFeatures.exists(store_path):
+            # Only the new and changed listings are read, the other rows come from the current features
+            update_listing_features(
+                store, ListingFeatures(previous_store), df[['id'] + FEATURE_COLUMNS],
+                cell_degrees=float(os.getenv('GEO_GRID_CELL_DEGREES', 0.01)), dataset_version=self.dataset_version,
+            )
+            self.features_saved = True
 
-        # Insert listings into the database
-        self._insert_listings_into_db(listings)
+        self._apply_changes(df, deleted_ids, affected, cluster_members)
+        self._replace_vector_files(staging_path, store_path)
+
+    def _apply_changes(self, df: pd.DataFrame, deleted_ids: np.ndarray, affected_clusters: List[int],
+                       cluster_members: pd.DataFrame):
+        '''
+        Applies an incremental refresh to the database in one transaction
+        '''
+        with self.db.get_connection() as conn:
+            conn.execute(
+                "DELETE FROM listing WHERE id IN (SELECT value FROM json_each(?))",
+                (json.dumps([int(i) for i in deleted_ids]),),
+            )
+            conn.executemany(INSERT_LISTING_QUERY, listing_rows(df))
+            conn.execute(
+                "DELETE FROM cluster_member WHERE cluster_id IN (SELECT value FROM json_each(?))",
+                (json.dumps(affected_clusters),),
+            )
+            conn.executemany(
+                INSERT_CLUSTER_MEMBER_QUERY,
+                cluster_members[['cluster_id', 'listing_id', 'rank']].itertuples(index=False, name=None),
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO dataset_meta (key, value) VALUES ('dataset_version', ?)",
+                (self.dataset_version,),
+            )
+            conn.commit()
 
     def _create_listing_table(self):
         '''
         Creates the listing table in the database
         '''
         self.db.execute_query(CREATE_TABLE_QUERY)
+        self.db.execute_query(CREATE_CLUSTER_MEMBER_TABLE_QUERY)
+        self.db.execute_query(CREATE_CLUSTER_MEMBER_INDEX_QUERY)
+        self.db.execute_query(CREATE_DATASET_META_TABLE_QUERY)
 
-    def _insert_listings_into_db(self, listings: List[Listing]):
+    def _bulk_load(self, df: pd.DataFrame, members: pd.DataFrame):
         '''
-        Inserts listings into the database
+        Builds the database into a fresh file next to DB_PATH in one unjournaled transaction,
+        creating the secondary indexes once the rows are in, then atomically swaps it into place
         '''
-        self.db.execute_queries(INSERT_LISTING_QUERY, [listing.dict() for listing in listings])
+        self.dataset_version = self._new_dataset_version()
+        build_path = self.db.db_path + '.build'
+        for path in (build_path, build_path + '-wal', build_path + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+        os.makedirs(os.path.dirname(os.path.abspath(build_path)), exist_ok=True)
 
-    def run(self):
+        conn = sqlite3.connect(build_path, isolation_level=None)
+        try:
+            # Nothing reads the file before it is complete, a failed build is simply discarded
+            conn.execute('PRAGMA journal_mode = OFF')
+            conn.execute('PRAGMA synchronous = OFF')
+            conn.execute('BEGIN')
+            conn.execute(CREATE_TABLE_QUERY)
+            conn.execute(CREATE_CLUSTER_MEMBER_TABLE_QUERY)
+            conn.execute(CREATE_DATASET_META_TABLE_QUERY)
+            conn.executemany(INSERT_LISTING_QUERY, listing_rows(df))
+            conn.executemany(
+                INSERT_CLUSTER_MEMBER_QUERY,
+                members.sort_values(['cluster_id', 'rank'])[['cluster_id', 'listing_id', 'rank']]
+                .itertuples(index=False, name=None),
+            )
+            conn.execute(
+                "INSERT INTO dataset_meta (key, value) VALUES ('dataset_version', ?)", (self.dataset_version,)
+            )
+            for query in CREATE_INDEX_QUERIES:
+                conn.execute(query)
+            conn.execute('COMMIT')
+        finally:
+            conn.close()
+        # Synchronous writes were off, flush the file before it replaces the current one
+        with open(build_path, 'rb') as f:
+            os.fsync(f.fileno())
+        replace_database(build_path, self.db.db_path)
+
+    @staticmethod
+    def _new_dataset_version() -> str:
+        return f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')}-{uuid.uuid4().hex[:8]}"
+
+    def _save_vector_store(self, df: pd.DataFrame, embeddings: np.ndarray, average_embeddings: np.ndarray):
+        '''
+        Writes the average and per-field embeddings to the vector store
+        '''
+        matrices = {'average': average_embeddings}
+        for i, field in enumerate(EMBEDDING_FIELDS):
+            matrices[field] = embeddings[:, i, :]
+        save_vector_store(
+            default_vector_store_path(),
+            df['id'].to_numpy(),
+            matrices,
+            dtype=os.getenv('VECTOR_STORE_DTYPE', 'float32'),
+        )
+
+    def _build_vector_index(self, store: Optional[VectorStore] = None):
+        '''
+        Trains the IVF index the API uses for approximate nearest neighbour search
+        '''
+        store = store or VectorStore(default_vector_store_path())
+        n_lists = os.getenv('IVF_N_LISTS')
+        build_ivf_index(store, n_lists=int(n_lists) if n_lists else None)
+
+    @staticmethod
+    def _replace_vector_files(staging_path: str, store_path: str):
+        '''
+        Moves the files of an incremental refresh over the current vector store. The meta files
+        go last and the listing features meta, whose stamp the API reloads on, after them all.
+        '''
+        last = [META_FILE, IVF_META_FILE, FEATURES_META_FILE]
+        names = sorted(os.listdir(staging_path), key=lambda name: last.index(name) if name in last else -1)
+        for name in names:
+            os.replace(os.path.join(staging_path, name), os.path.join(store_path, name))
+        os.rmdir(staging_path)
+
+    def _save_listing_features(self):
+        '''
+        Writes the columnar listing attributes and geo grid the API filters k-NN results with
+        '''
+        store = VectorStore(default_vector_store_path())
+        listings = pd.DataFrame(
+            self.db.fetch_data(f"SELECT id, {', '.join(FEATURE_COLUMNS)} FROM listing"),
+            columns=['id'] + FEATURE_COLUMNS,
+        )
+        save_listing_features(
+            store, listings, cell_degrees=float(os.getenv('GEO_GRID_CELL_DEGREES', 0.01)),
+            dataset_version=self.dataset_version,
+        )
+
+    def _build_snapshot(self):
+        '''
+        Writes the snapshot with the precomputed nearest neighbours of every listing
+        '''
+        store = VectorStore(default_vector_store_path())
+        index = load_vector_index(store, backend=os.getenv('VECTOR_INDEX_BACKEND', 'ivf'))
+        build_snapshot(
+            self.db,
+            default_snapshot_path(),
+            index=index,
+            neighbours_k=int(os.getenv('SNAPSHOT_NEIGHBOURS', 50)),
+            dataset_version=self.dataset_version,
+        )
+
+    def run(self, incremental: bool = False, start_stage: str = 'clean'):
         print("Loading data into the database...")
-        self.load_data()
+        if incremental:
+            self.load_data_incremental()
+        else:
+            self.load_data(start_stage)
         print("Data loaded successfully.")
+        if self.dataset_version is None:
+            # Nothing changed, the files below are rewritten for the current version
+            row = self.db.fetch_data("SELECT value FROM dataset_meta WHERE key = 'dataset_version'", fetch_all=False)
+            self.dataset_version = row['value'] if row else None
+        if not self.features_saved:
+            self._save_listing_features()
+
+        if os.getenv('LISTING_BACKEND', 'sqlite') == 'snapshot':
+            # Emit the read-only snapshot the API serves from instead of SQLite
+            print("Building snapshot...")
+            self._build_snapshot()
+            print(f"Snapshot written to {default_snapshot_path()}")
 
         # Fetch and print a sample listing
-        sample_query = "SELECT * FROM listing LIMIT 1"
+        sample_query = f"SELECT {', '.join(Listing.model_fields)} FROM listing LIMIT 1"
         sample_listing = self.db.fetch_data(sample_query, fetch_all=False)
         print("\nSample listing:")
         print(json.dumps(sample_listing, indent=2))
 
-if __name__ == '__main__':
+def _init_market_worker(threads: int):
+    '''
+    Splits the cores between the workers and loads the model once, for every market the
+    worker builds
+    '''
+    torch.set_num_threads(threads)
+    os.environ.setdefault('CLUSTERING_N_JOBS', str(threads))
+    load_model(os.getenv('SENTENCE_TRANSFORMER_MODEL'))
+
+def _build_market(name: str, csv_path: str, db_path: str, incremental: bool, start_stage: str) -> str:
+    '''
+    Builds one market into its own database, vector store and snapshot in a pool worker
+    '''
+    os.environ['DB_PATH'] = db_path
+    os.environ['NYC_CSV_FILEPATH'] = csv_path
+    for key in MARKET_DERIVED_PATHS:
+        os.environ.pop(key, None)
+    print(f"[{name}] Building from {csv_path}")
+    LaunchDB(db_path).run(incremental=incremental, start_stage=start_stage)
+    return name
+
+def build_markets(markets: Dict[str, str], incremental: bool = False, start_stage: str = 'clean',
+                  workers: Optional[int] = None):
+    '''
+    Builds every market in a process pool, then writes the id -> market index the API routes
+    lookups with to DB_PATH. Markets that fail keep their previous database and are reported
+    once the index is written for the others.
+    '''
+    workers = max(1, min(workers or int(os.getenv('MARKET_WORKERS', 2)), len(markets)))
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    paths = {name: market_db_path(name) for name in markets}
+    failed = {}
+    # Spawned workers don't inherit the parent's torch/BLAS thread pools
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_market_worker,
+                             initargs=(threads,)) as executor:
+        futures = {
+            executor.submit(_build_market, name, csv_path, paths[name], incremental, start_stage): name
+            for name, csv_path in markets.items()
+        }
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                future.result()
+                print(f"[{name}] Done.")
+            except Exception:
+                failed[name] = traceback.format_exc()
+                print(f"[{name}] Failed:\n{failed[name]}")
+
+    os.makedirs(os.path.dirname(os.path.abspath(os.getenv('DB_PATH'))), exist_ok=True)
+    count = write_market_index(AirbnbDatabase(), paths, LaunchDB._new_dataset_version())
+    print(f"Indexed {count} listings from {len(markets) - len(failed)} markets in {os.getenv('DB_PATH')}")
+    if failed:
+        raise click.ClickException(f"Markets failed to build: {', '.join(sorted(failed))}")
+
+@click.command()
+@click.option("--incremental", is_flag=True, help="Only process listings that changed since the last load.")
+@click.option("--from-stage", type=click.Choice(STAGES), default='clean',
+              help="Resume a full load from this stage, reading the earlier stages' artifacts.")
+@click.option("--markets", "build_all_markets", is_flag=True,
+              help="Build every market in MARKETS in a process pool and index them in DB_PATH.")
+def main(incremental, from_stage, build_all_markets):
+    if build_all_markets:
+        markets = parse_markets(os.getenv('MARKETS'))
+        if not markets:
+            raise click.UsageError("MARKETS is empty, set it to name=csv_path,...")
+        build_markets(markets, incremental=incremental, start_stage=from_stage)
+        return
     launcher = LaunchDB()
-    launcher.run()
\ No newline at end of file
+    launcher.run(incremental=incremental, start_stage=from_stage)
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,353 @@
+import os
+import json
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+from app.core.database.vector_store import VectorStore, write_npy
+
+FEATURES_META_FILE = 'features_meta.json'
+GRID_KEYS_FILE = 'grid_keys.npy'
+GRID_OFFSETS_FILE = 'grid_offsets.npy'
+GRID_ROWS_FILE = 'grid_rows.npy'
+
+# Listing columns kept as arrays aligned with the vector store rows. Coordinates are float64
+# so distances stay accurate to the metre
+NUMERIC_FEATURES = {
+    'price': np.float32,
+    'bedrooms': np.float32,
+    'accommodates': np.float32,
+    'review_scores_rating': np.float32,
+    'latitude': np.float64,
+    'longitude': np.float64,
+}
+CATEGORICAL_FEATURES = ['room_type']
+FEATURE_COLUMNS = list(NUMERIC_FEATURES) + CATEGORICAL_FEATURES
+
+# Numeric columns compared by hybrid ranking, price on a log scale since it is heavy tailed
+RANKING_FEATURES = ['price', 'bedrooms', 'accommodates', 'review_scores_rating']
+LOG_SCALED_FEATURES = {'price'}
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def haversine_m(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    '''
+    Great-circle distances in metres from one point to arrays of points, all in degrees
+    '''
+    lat, lon = np.radians(lat), np.radians(lon)
+    lats, lons = np.radians(lats), np.radians(lons)
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def _cell_range(cell_degrees: float) -> Tuple[int, int]:
+    # Cells per degree band, used to flatten (lat cell, lon cell) into one sortable key
+    lat_offset = int(np.ceil(90 / cell_degrees)) + 1
+    lon_cells = int(np.ceil(360 / cell_degrees)) + 3
+    return lat_offset, lon_cells
+
+
+def _cell_keys(lats: np.ndarray, lons: np.ndarray, cell_degrees: float) -> np.ndarray:
+    lat_offset, lon_cells = _cell_range(cell_degrees)
+    lat_cells = np.floor(lats / cell_degrees).astype(np.int64) + lat_offset
+    lon_cell = np.floor(lons / cell_degrees).astype(np.int64) + lon_cells // 2
+    return lat_cells * lon_cells + lon_cell
+
+
+def _ranking_values(name: str, values: np.ndarray) -> np.ndarray:
+    values = np.asarray(values, dtype=np.float64)
+    return np.log1p(np.maximum(values, 0)) if name in LOG_SCALED_FEATURES else values
+
+
+def _feature_scale(name: str, column: np.ndarray) -> float:
+    # Standard deviation of the ranking values, 1 for constant or empty columns
+    values = _ranking_values(name, column)
+    values = values[~np.isnan(values)]
+    scale = float(values.std()) if len(values) else 0.0
+    return scale if scale > 0 else 1.0
+
+
+def save_listing_features(store: VectorStore, listings: pd.DataFrame, cell_degrees: float = 0.01,
+                          dataset_version: Optional[str] = None) -> None:
+    '''
+    Writes the FEATURE_COLUMNS of `listings` as arrays aligned with the store rows (NaN, or
+    -1 for categories, where a stored listing has no row), plus a grid of
+    `cell_degrees` cells over the coordinates: rows sorted by cell and the offsets of every
+    non-empty cell, so a radius query only reads the cells around it. The meta file is
+    written last and stamped with `dataset_version`, the API reloads once it matches the
+    database's.
+    '''
+    positions = store.rows(listings['id'].to_numpy())
+    found = positions >= 0
+    positions = positions[found]
+    listings = listings[found]
+    n = len(store)
+
+    numeric = {}
+    for name, dtype in NUMERIC_FEATURES.items():
+        column = np.full(n, np.nan, dtype=dtype)
+        column[positions] = pd.to_numeric(listings[name], errors='coerce').to_numpy(dtype=dtype, na_value=np.nan)
+        numeric[name] = column
+    categorical = {}
+    for name in CATEGORICAL_FEATURES:
+        values = listings[name].astype(object).where(listings[name].notna(), None)
+        categories = sorted({value for value in values if value is not None})
+        codes = np.full(n, -1, dtype=np.int16)
+        codes[positions] = pd.Categorical(values, categories=categories).codes
+        categorical[name] = (codes, categories)
+    _write_listing_features(store, numeric, categorical, cell_degrees, dataset_version)
+
+
+def update_listing_features(store: VectorStore, previous: 'ListingFeatures', listings: pd.DataFrame,
+                            cell_degrees: float = 0.01, dataset_version: Optional[str] = None) -> None:
+    '''
+    Writes the listing features of `store` after an incremental vector store update: rows of
+    listings that are still stored are copied from `previous` (opened on the store before
+    the update), only the new and changed `listings` are read. The grid, scales and
+    categories are recomputed over the whole store as `save_listing_features` does.
+    '''
+    n = len(store)
+    previous_rows = previous.store.rows(store.ids)
+    kept = previous_rows >= 0
+    previous_rows = previous_rows[kept]
+    positions = store.rows(listings['id'].to_numpy())
+    found = positions >= 0
+    positions = positions[found]
+    listings = listings[found]
+
+    numeric = {}
+    for name, dtype in NUMERIC_FEATURES.items():
+        column = np.full(n, np.nan, dtype=dtype)
+        column[kept] = previous.columns[name][previous_rows]
+        column[positions] = pd.to_numeric(listings[name], errors='coerce').to_numpy(dtype=dtype, na_value=np.nan)
+        numeric[name] = column
+    categorical = {}
+    for name in CATEGORICAL_FEATURES:
+        values = listings[name].astype(object).where(listings[name].notna(), None)
+        previous_categories = previous.categories[name]
+        categories = sorted(set(previous_categories) | {value for value in values if value is not None})
+        previous_codes = np.asarray(previous.columns[name][previous_rows], dtype=np.int64)
+        remap = np.array([categories.index(c) for c in previous_categories] + [-1], dtype=np.int64)
+        codes = np.full(n, -1, dtype=np.int64)
+        codes[kept] = remap[previous_codes]
+        codes[positions] = pd.Categorical(values, categories=categories).codes
+        # Drop the categories only deleted or changed listings had
+        used = np.unique(codes[codes >= 0])
+        remap = np.full(len(categories) + 1, -1, dtype=np.int64)
+        remap[used] = np.arange(len(used))
+        categorical[name] = (remap[codes].astype(np.int16), [categories[i] for i in used])
+    _write_listing_features(store, numeric, categorical, cell_degrees, dataset_version)
+
+
+def _write_listing_features(store: VectorStore, numeric: Dict[str, np.ndarray],
+                            categorical: Dict[str, Tuple[np.ndarray, List[str]]], cell_degrees: float,
+                            dataset_version: Optional[str]) -> None:
+    meta = {
+        'count': int(len(store)), 'numeric': list(numeric), 'categories': {}, 'cell_degrees': cell_degrees,
+        'scales': {}, 'dataset_version': dataset_version,
+    }
+    for name, column in numeric.items():
+        write_npy(os.path.join(store.path, f'feature_{name}.npy'), column)
+        if name in RANKING_FEATURES:
+            meta['scales'][name] = _feature_scale(name, column)
+    for name, (codes, categories) in categorical.items():
+        write_npy(os.path.join(store.path, f'feature_{name}.npy'), codes)
+        meta['categories'][name] = categories
+
+    lats, lons = numeric['latitude'], numeric['longitude']
+    located = np.flatnonzero(~np.isnan(lats) & ~np.isnan(lons))
+    keys = _cell_keys(lats[located], lons[located], cell_degrees)
+    order = np.argsort(keys, kind='stable')
+    cell_keys, counts = np.unique(keys[order], return_counts=True)
+    write_npy(os.path.join(store.path, GRID_KEYS_FILE), cell_keys.astype(np.int64))
+    write_npy(os.path.join(store.path, GRID_OFFSETS_FILE), np.concatenate([[0], np.cumsum(counts)]).astype(np.int64))
+    write_npy(os.path.join(store.path, GRID_ROWS_FILE), located[order].astype(np.int64))
+
+    with open(os.path.join(store.path, FEATURES_META_FILE + '.tmp'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(os.path.join(store.path, FEATURES_META_FILE + '.tmp'), os.path.join(store.path, FEATURES_META_FILE))
+
+
+class ListingFeatures:
+    """
+    Memory mapped listing attributes in vector store row order, for filtering and scoring
+    k-NN candidates without touching SQLite.
+    """
+    def __init__(self, store: VectorStore):
+        self.store = store
+        with open(os.path.join(store.path, FEATURES_META_FILE)) as f:
+            self.meta = json.load(f)
+        if self.meta['count'] != len(store):
+            raise ValueError(f"Listing features in {store.path} don't match the vector store, rerun `make create_db`")
+        self.columns = {
+            name: np.load(os.path.join(store.path, f'feature_{name}.npy'), mmap_mode='r')
+            for name in self.meta['numeric'] + list(self.meta['categories'])
+        }
+        self.categories: Dict[str, List[str]] = self.meta['categories']
+        self.cell_degrees = self.meta['cell_degrees']
+        self.dataset_version: Optional[str] = self.meta.get('dataset_version')
+        self.grid_keys = np.load(os.path.join(store.path, GRID_KEYS_FILE))
+        self.grid_offsets = np.load(os.path.join(store.path, GRID_OFFSETS_FILE))
+        self.grid_rows = np.load(os.path.join(store.path, GRID_ROWS_FILE), mmap_mode='r')
+        self.scales: Dict[str, float] = self.meta.get('scales') or {
+            name: _feature_scale(name, self.columns[name]) for name in RANKING_FEATURES
+        }
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, FEATURES_META_FILE))
+
+    def location(self, row: int) -> Optional[Tuple[float, float]]:
+        lat, lon = float(self.columns['latitude'][row]), float(self.columns['longitude'][row])
+        if np.isnan(lat) or np.isnan(lon):
+            return None
+        return lat, lon
+
+    def rows_within(self, lat: float, lon: float, radius_m: float) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        Returns the sorted rows within `radius_m` of a point and their distances in metres.
+        Only the grid cells overlapping the radius' bounding box are read, then candidates
+        are checked with the haversine distance.
+        '''
+        lat_offset, lon_cells = _cell_range(self.cell_degrees)
+        delta_lat = np.degrees(radius_m / EARTH_RADIUS_M)
+        delta_lon = delta_lat / max(np.cos(np.radians(min(abs(lat) + delta_lat, 90.0))), 1e-9)
+        lon_lo = int(np.floor(max(lon - delta_lon, -180.0) / self.cell_degrees)) + lon_cells // 2
+        lon_hi = int(np.floor(min(lon + delta_lon, 180.0) / self.cell_degrees)) + lon_cells // 2
+        lat_lo = int(np.floor((lat - delta_lat) / self.cell_degrees)) + lat_offset
+        lat_hi = int(np.floor((lat + delta_lat) / self.cell_degrees)) + lat_offset
+
+        # Cells of one latitude band are consecutive keys, so every band is one slice of the grid
+        bands = np.arange(lat_lo, lat_hi + 1, dtype=np.int64) * lon_cells
+        starts = self.grid_offsets[np.searchsorted(self.grid_keys, bands + lon_lo, side='left')]
+        ends = self.grid_offsets[np.searchsorted(self.grid_keys, bands + lon_hi, side='right')]
+        candidates = np.concatenate([self.grid_rows[s:e] for s, e in zip(starts, ends)] or [np.empty(0, np.int64)])
+        if len(candidates) == 0:
+            return candidates.astype(np.int64), np.empty(0)
+
+        candidates = np.sort(candidates)
+        distances = haversine_m(lat, lon, self.columns['latitude'][candidates], self.columns['longitude'][candidates])
+        inside = distances <= radius_m
+        return candidates[inside], distances[inside]
+
+    def nearby(self, listing_id: int, radius_m: float, k: int) -> Optional[List[Tuple[int, float]]]:
+        '''
+        Returns the k closest listings within `radius_m` of a stored listing as (id, distance
+        in metres) pairs, closest first. None when the listing isn't stored
+        '''
+        row = self.store.row(listing_id)
+        if row is None:
+            return None
+        location = self.location(row)
+        if location is None:
+            return []
+        rows, distances = self.rows_within(*location, radius_m)
+        others = rows != row
+        rows, distances = rows[others], distances[others]
+        if len(rows) > k:
+            keep = np.argpartition(distances, k - 1)[:k]
+            rows, distances = rows[keep], distances[keep]
+        order = np.lexsort((rows, distances))
+        return [(int(self.store.ids[r]), float(d)) for r, d in zip(rows[order], distances[order])]
+
+    def hybrid_scores(self, row: int, rows: np.ndarray, similarities: np.ndarray, embedding_weight: float = 1.0,
+                      numeric_weight: float = 0.0, geo_weight: float = 0.0, geo_scale_m: float = 2000.0) -> np.ndarray:
+        '''
+        Scores candidate `rows` of the listing at `row` as a weighted sum of their cosine
+        `similarities`, a numeric similarity and a geo similarity, the latter two in [0, 1].
+
+        The numeric similarity is exp(-d), d the mean over RANKING_FEATURES of the absolute
+        difference in standard deviations, skipping values either listing lacks. The geo
+        similarity is exp(-distance / geo_scale_m). Both are 0 when nothing can be compared.
+        '''
+        rows = np.asarray(rows, dtype=np.int64)
+        scores = embedding_weight * np.asarray(similarities, dtype=np.float64)
+
+        if numeric_weight:
+            # (candidates, features) block of differences in units of each feature's spread
+            block = np.column_stack([
+                _ranking_values(name, self.columns[name][rows]) / self.scales[name] for name in RANKING_FEATURES
+            ])
+            origin = np.array([
+                _ranking_values(name, self.columns[name][row]) / self.scales[name] for name in RANKING_FEATURES
+            ])
+            differences = np.abs(block - origin)
+            compared = (~np.isnan(differences)).sum(axis=1)
+            distance = np.nansum(differences, axis=1) / np.maximum(compared, 1)
+            scores += numeric_weight * np.where(compared > 0, np.exp(-distance), 0.0)
+
+        if geo_weight:
+            location = self.location(row)
+            if location is not None:
+                distances = haversine_m(*location, self.columns['latitude'][rows], self.columns['longitude'][rows])
+                scores += geo_weight * np.nan_to_num(np.exp(-distances / geo_scale_m), nan=0.0)
+        return scores
+
+    def matching_rows(self, min_price: Optional[float] = None, max_price: Optional[float] = None,
+                      room_types: Optional[Sequence[str]] = None,
+                      near: Optional[Tuple[float, float, float]] = None) -> np.ndarray:
+        '''
+        Returns the sorted rows matching every given predicate. `near` is (latitude,
+        longitude, radius in metres): its grid candidates are found first and the other
+        predicates only read their rows, otherwise they are evaluated over whole columns.
+        '''
+        rows = self.rows_within(*near)[0] if near else None
+
+        def column(name: str) -> np.ndarray:
+            values = self.columns[name]
+            return np.asarray(values if rows is None else values[rows])
+
+        keep = np.ones(len(self.store) if rows is None else len(rows), dtype=bool)
+        if min_price is not None:
+            keep &= column('price') >= min_price
+        if max_price is not None:
+            keep &= column('price') <= max_price
+        if room_types:
+            categories = self.categories['room_type']
+            codes = [categories.index(room_type) for room_type in room_types if room_type in categories]
+            keep &= np.isin(column('room_type'), codes)
+        return np.flatnonzero(keep) if rows is None else rows[keep]
+
+
+def rerank_neighbours(features: ListingFeatures, listing_id: int, neighbours: List[Tuple[int, float]], k: int,
+                      embedding_weight: float = 1.0, numeric_weight: float = 0.0, geo_weight: float = 0.0,
+                      geo_scale_m: float = 2000.0) -> List[Tuple[int, float]]:
+    '''
+    Reorders the (id, cosine score) candidates of a stored listing by `hybrid_scores` and
+    keeps the k best, as (id, hybrid score) pairs
+    '''
+    row = features.store.row(listing_id)
+    if row is None or not neighbours:
+        return neighbours[:k]
+    ids = np.array([id for id, _ in neighbours], dtype=np.int64)
+    rows = features.store.rows(ids)
+    scores = features.hybrid_scores(
+        row, rows, np.array([score for _, score in neighbours]),
+        embedding_weight, numeric_weight, geo_weight, geo_scale_m,
+    )
+    order = np.argsort(-scores, kind='stable')[:k]
+    return [(int(ids[i]), float(scores[i])) for i in order]
+
+
+def filtered_neighbours(index, features: ListingFeatures, listing_id: int, k: int,
+                        min_price: Optional[float] = None, max_price: Optional[float] = None,
+                        room_types: Optional[Sequence[str]] = None, radius_m: Optional[float] = None,
+                        prefilter_rows: int = 10000) -> Optional[List[Tuple[int, float]]]:
+    '''
+    The k nearest listings to a stored listing among those matching the filters, with the
+    radius measured from the listing itself. Returns None when the listing has no vector
+    '''
+    row = index.store.row(listing_id)
+    if row is None:
+        return None
+    near = None
+    if radius_m is not None:
+        location = features.location(row)
+        if location is None:
+            return []
+        near = (*location, radius_m)
+    rows = features.matching_rows(min_price, max_price, room_types, near)
+    query = index.store.matrix(index.name)[row]
+    return index.search_filtered(query, k, rows, exclude_row=row, prefilter_rows=prefilter_rows)
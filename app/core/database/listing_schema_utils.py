@@ -40,7 +40,23 @@ LISTING_TABLE_SCHEMA = ('''
     property_outline TEXT NOT NULL,
     high_level_overview TEXT NOT NULL,
     cluster INTEGER NOT NULL,
-    listings_in_cluster TEXT NOT NULL
+    content_hash TEXT
+''')
+
+# One row per (cluster, member), ranked by similarity to the cluster centroid.
+# Noise listings (cluster -1) have no rows.
+CLUSTER_MEMBER_TABLE_SCHEMA = ('''
+    cluster_id INTEGER NOT NULL,
+    listing_id INTEGER NOT NULL,
+    rank INTEGER NOT NULL,
+    PRIMARY KEY (cluster_id, rank)
+''')
+                        
+# Key/value facts about the loaded dataset, e.g. the `dataset_version` stamp written by
+# every load so caches in the API know when to drop their entries
+DATASET_META_TABLE_SCHEMA = ('''
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
 ''')
                         
 class Listing(BaseModel):
@@ -72,7 +88,6 @@ class Listing(BaseModel):
     property_outline: str
     high_level_overview: str
     cluster: int
-    listings_in_cluster: str
 
 def load_listings(local_path: str = os.getenv('NYC_CSV_FILEPATH')) -> pd.DataFrame:
     '''
@@ -0,0 +1,222 @@
+import os
+import json
+import sqlite3
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from app.core.database.db import AirbnbDatabase, ConnectionPool
+from app.core.database.listing_schema_utils import DATASET_META_TABLE_SCHEMA
+
+CREATE_MARKET_TABLE_QUERY = '''
+CREATE TABLE IF NOT EXISTS market (
+    name TEXT PRIMARY KEY,
+    db_path TEXT NOT NULL,
+    listing_count INTEGER NOT NULL,
+    dataset_version TEXT
+)
+'''
+
+CREATE_LISTING_MARKET_TABLE_QUERY = '''
+CREATE TABLE IF NOT EXISTS listing_market (
+    listing_id INTEGER PRIMARY KEY,
+    market TEXT NOT NULL
+) WITHOUT ROWID
+'''
+
+CREATE_DATASET_META_TABLE_QUERY = f'''
+CREATE TABLE IF NOT EXISTS dataset_meta ({DATASET_META_TABLE_SCHEMA})
+'''
+
+
+def parse_markets(spec: Optional[str]) -> Dict[str, str]:
+    '''
+    Parses `name=csv_path,name=csv_path` (the MARKETS setting) into {name: csv_path}
+    '''
+    markets = {}
+    for entry in (spec or '').split(','):
+        if not entry.strip():
+            continue
+        name, sep, csv_path = entry.partition('=')
+        name, csv_path = name.strip(), csv_path.strip()
+        if not sep or not name or not csv_path:
+            raise ValueError(f"Invalid market '{entry}', expected name=csv_path")
+        if name in markets:
+            raise ValueError(f"Market '{name}' is listed twice")
+        markets[name] = csv_path
+    return markets
+
+
+def default_markets_path() -> str:
+    '''
+    Returns the configured directory of market partitions, defaulting to a sibling of the DB file
+    '''
+    path = os.getenv('MARKETS_PATH')
+    if path:
+        return path
+    return os.path.splitext(os.getenv('DB_PATH'))[0] + '_markets'
+
+
+def market_db_path(name: str, path: Optional[str] = None) -> str:
+    '''
+    Every market is a full database of its own; the vector store, snapshot, artifacts and
+    embedding cache default to siblings of it
+    '''
+    return os.path.join(path or default_markets_path(), name, 'airbnb.db')
+
+
+def market_paths(index_db: AirbnbDatabase) -> Dict[str, str]:
+    '''
+    Returns {market: database path} from the market index, in market name order
+    '''
+    return {row['name']: row['db_path'] for row in index_db.fetch_data("SELECT name, db_path FROM market ORDER BY name")}
+
+
+def has_market_index(db: AirbnbDatabase) -> bool:
+    row = db.fetch_data(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'market'", fetch_all=False
+    )
+    return row is not None
+
+
+def _market_version(db: AirbnbDatabase) -> Optional[str]:
+    try:
+        row = db.fetch_data("SELECT value FROM dataset_meta WHERE key = 'dataset_version'", fetch_all=False)
+    except sqlite3.OperationalError:
+        return None
+    return row['value'] if row else None
+
+
+def write_market_index(index_db: AirbnbDatabase, market_paths: Dict[str, str], dataset_version: str) -> int:
+    '''
+    Rebuilds the id -> market index from the listings of every market database that exists,
+    and stamps it with `dataset_version`, in one transaction. Returns the number of listings.
+    '''
+    markets = []
+    for name, db_path in sorted(market_paths.items()):
+        if os.path.exists(db_path):
+            db = AirbnbDatabase(db_path)
+            ids = [row['id'] for row in db.fetch_data("SELECT id FROM listing")]
+            markets.append((name, db_path, ids, _market_version(db)))
+
+    with index_db.get_connection() as conn:
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute(CREATE_MARKET_TABLE_QUERY)
+        conn.execute(CREATE_LISTING_MARKET_TABLE_QUERY)
+        conn.execute(CREATE_DATASET_META_TABLE_QUERY)
+        conn.execute('DELETE FROM market')
+        conn.execute('DELETE FROM listing_market')
+        for name, db_path, ids, version in markets:
+            conn.execute(
+                "INSERT INTO market (name, db_path, listing_count, dataset_version) VALUES (?, ?, ?, ?)",
+                (name, os.path.abspath(db_path), len(ids), version),
+            )
+            try:
+                conn.executemany(
+                    "INSERT INTO listing_market (listing_id, market) VALUES (?, ?)", ((i, name) for i in ids)
+                )
+            except sqlite3.IntegrityError:
+                conn.rollback()
+                raise ValueError(f"Market '{name}' has listing ids that another market already has")
+        conn.execute(
+            "INSERT OR REPLACE INTO dataset_meta (key, value) VALUES ('dataset_version', ?)", (dataset_version,)
+        )
+        conn.commit()
+    return sum(len(ids) for _, _, ids, _ in markets)
+
+
+class MarketRouter:
+    """
+    Routes listing lookups to the database of the market a listing belongs to, through the
+    `listing_market` index (a primary key lookup in the index database). Every market gets
+    its own pool of read-only connections.
+
+    The markets and their listing counts are read once; `reopen` returns a router over the
+    current market index, reusing the pools of the markets it still lists.
+    """
+    def __init__(self, index_db: AirbnbDatabase, min_connections: int = 1, max_connections: int = 10,
+                 reuse: Optional[Dict[str, AirbnbDatabase]] = None, **pool_options):
+        self.index_db = index_db
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.pool_options = pool_options
+        self.counts: Dict[str, int] = {}
+        self.markets: Dict[str, AirbnbDatabase] = {}
+        for row in index_db.fetch_data("SELECT name, db_path, listing_count FROM market ORDER BY name"):
+            db = (reuse or {}).get(row['name'])
+            if db is None or db.db_path != row['db_path']:
+                pool = ConnectionPool(
+                    row['db_path'], min_size=min_connections, max_size=max_connections, read_only=True, **pool_options
+                )
+                db = AirbnbDatabase(row['db_path'], pool=pool)
+            self.markets[row['name']] = db
+            self.counts[row['name']] = row['listing_count']
+
+    def reopen(self) -> 'MarketRouter':
+        '''
+        Returns a router over the markets the index lists now, e.g. after `make create_markets_db`.
+        Requests holding this router keep using it; the pools of markets that left the index
+        are closed once nothing references them.
+        '''
+        return MarketRouter(
+            self.index_db, self.min_connections, self.max_connections, reuse=self.markets, **self.pool_options
+        )
+
+    def __len__(self) -> int:
+        return sum(self.counts.values())
+
+    def market_of(self, listing_id: int) -> Optional[str]:
+        row = self.index_db.fetch_data(
+            "SELECT market FROM listing_market WHERE listing_id = :id", {'id': listing_id}, fetch_all=False
+        )
+        return row['market'] if row else None
+
+    def database_for(self, listing_id: int) -> Optional[AirbnbDatabase]:
+        market = self.market_of(listing_id)
+        return self.markets.get(market) if market else None
+
+    def group_by_market(self, listing_ids: Sequence[int]) -> Dict[str, List[int]]:
+        '''
+        Returns {market: ids} for the known ids, keeping their order within a market
+        '''
+        rows = self.index_db.fetch_data(
+            """
+            SELECT requested.value AS listing_id, listing_market.market
+            FROM json_each(:ids) AS requested
+            JOIN listing_market ON listing_market.listing_id = requested.value
+            ORDER BY requested.key
+            """,
+            {'ids': json.dumps([int(i) for i in listing_ids])},
+        )
+        groups: Dict[str, List[int]] = {}
+        for row in rows:
+            groups.setdefault(row['market'], []).append(row['listing_id'])
+        return groups
+
+    def pages(self, skip: int, limit: int) -> Iterator[Tuple[AirbnbDatabase, int, int]]:
+        '''
+        Splits a page over the listings of all markets, in market name order, into
+        (database, skip, limit) pages of the markets it spans
+        '''
+        for name, count in self.counts.items():
+            if limit <= 0:
+                return
+            if skip >= count:
+                skip -= count
+                continue
+            take = min(limit, count - skip)
+            yield self.markets[name], skip, take
+            skip, limit = 0, limit - take
+
+    def close(self) -> None:
+        for db in self.markets.values():
+            db.close_connection()
+        self.markets = {}
+
+
+_market_router: Optional[MarketRouter] = None
+
+def set_market_router(router: Optional[MarketRouter]) -> None:
+    global _market_router
+    _market_router = router
+
+def get_market_router() -> Optional[MarketRouter]:
+    return _market_router
@@ -0,0 +1,210 @@
+import os
+import json
+import struct
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.core.database.db import AirbnbDatabase
+from app.core.database.listing_schema_utils import Listing
+
+MAGIC = b'ABNBSNP1'
+ALIGNMENT = 64
+
+
+def default_snapshot_path() -> str:
+    '''
+    Returns the configured snapshot file, defaulting to a sibling of the DB file
+    '''
+    path = os.getenv('SNAPSHOT_PATH')
+    if path:
+        return path
+    return os.path.splitext(os.getenv('DB_PATH'))[0] + '.snapshot'
+
+
+def _align(offset: int) -> int:
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def write_snapshot(path: str, sections: Dict[str, np.ndarray], meta: Dict[str, Any]) -> None:
+    '''
+    Writes named arrays into one file: magic, header length, JSON header, then every array
+    at a 64 byte aligned offset. The file is written aside and renamed into place.
+    '''
+    header = dict(meta, sections={})
+    # The header records offsets, which depend on its own length: size it with placeholders first
+    for name, array in sections.items():
+        header['sections'][name] = {'offset': 0, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+    header_len = len(json.dumps(header).encode()) + 32 * len(sections)
+    offset = _align(len(MAGIC) + 8 + header_len)
+    for name, array in sections.items():
+        header['sections'][name]['offset'] = offset
+        offset = _align(offset + array.nbytes)
+
+    header_bytes = json.dumps(header).encode().ljust(header_len)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', header_len))
+        f.write(header_bytes)
+        for name, array in sections.items():
+            f.seek(header['sections'][name]['offset'])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.truncate(offset)
+    os.replace(tmp_path, path)
+
+
+def build_snapshot(db: AirbnbDatabase, path: str, index=None, neighbours_k: int = 50,
+                   dataset_version: Optional[str] = None, batch_size: int = 1024) -> None:
+    '''
+    Builds the snapshot from the listing and cluster_member tables, with each listing's
+    `neighbours_k` nearest neighbours precomputed from `index` when one is given
+    '''
+    # Only the public Listing fields, internal columns such as content_hash stay in SQLite
+    rows = db.fetch_data(f"SELECT {', '.join(Listing.model_fields)} FROM listing ORDER BY id", fetch_all=True)
+    ids = np.array([row['id'] for row in rows], dtype=np.int64)
+    clusters = np.array([row['cluster'] for row in rows], dtype=np.int64)
+
+    payloads = [json.dumps({k: v for k, v in row.items() if k != 'id'}).encode() for row in rows]
+    payload_offsets = np.zeros(len(payloads) + 1, dtype=np.uint64)
+    np.cumsum([len(p) for p in payloads], out=payload_offsets[1:])
+    payload = np.frombuffer(b''.join(payloads), dtype=np.uint8)
+    del rows, payloads
+
+    members = db.fetch_data(
+        "SELECT cluster_id, listing_id FROM cluster_member ORDER BY cluster_id, rank", fetch_all=True
+    )
+    member_clusters = np.array([m['cluster_id'] for m in members], dtype=np.int64)
+    cluster_keys, counts = np.unique(member_clusters, return_counts=True)
+    cluster_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+    cluster_members = np.array([m['listing_id'] for m in members], dtype=np.int64)
+
+    neighbour_ids = np.full((len(ids), neighbours_k if index else 0), -1, dtype=np.int64)
+    neighbour_scores = np.zeros(neighbour_ids.shape, dtype=np.float32)
+    if index:
+        for start in range(0, len(ids), batch_size):
+            results = index.search_by_ids(ids[start:start + batch_size].tolist(), neighbours_k)
+            for i, listing_id in enumerate(ids[start:start + batch_size], start=start):
+                for j, (neighbour, score) in enumerate(results.get(int(listing_id), [])):
+                    neighbour_ids[i, j] = neighbour
+                    neighbour_scores[i, j] = score
+
+    write_snapshot(path, {
+        'ids': ids,
+        'clusters': clusters,
+        'payload_offsets': payload_offsets,
+        'payload': payload,
+        'cluster_keys': cluster_keys.astype(np.int64),
+        'cluster_offsets': cluster_offsets,
+        'cluster_members': cluster_members,
+        'neighbour_ids': neighbour_ids,
+        'neighbour_scores': neighbour_scores,
+    }, {'count': int(len(ids)), 'neighbours_k': int(neighbour_ids.shape[1]), 'dataset_version': dataset_version})
+
+
+class ListingSnapshot:
+    """
+    Read-only listing backend over a memory mapped snapshot file: id -> listing fields and
+    id -> neighbours are binary searches over the sorted id array, with no SQL parsing or
+    connection handling on the hot path.
+
+    It also answers `search_by_id`/`search_by_ids` like a VectorIndex, from the precomputed
+    neighbours (at most `neighbours_k` of them).
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self._buffer = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(self._buffer[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{path} is not a listing snapshot")
+        header_len = struct.unpack('<Q', bytes(self._buffer[len(MAGIC):len(MAGIC) + 8]))[0]
+        start = len(MAGIC) + 8
+        self.meta = json.loads(bytes(self._buffer[start:start + header_len]))
+        sections = {name: self._section(section) for name, section in self.meta['sections'].items()}
+        self.ids = sections['ids']
+        self.clusters = sections['clusters']
+        self.payload_offsets = sections['payload_offsets']
+        self.payload = sections['payload']
+        self.cluster_keys = sections['cluster_keys']
+        self.cluster_offsets = sections['cluster_offsets']
+        self.cluster_members = sections['cluster_members']
+        self.neighbour_ids = sections['neighbour_ids']
+        self.neighbour_scores = sections['neighbour_scores']
+
+    def _section(self, section: Dict[str, Any]) -> np.ndarray:
+        dtype = np.dtype(section['dtype'])
+        count = int(np.prod(section['shape'])) if section['shape'] else 1
+        array = np.frombuffer(self._buffer, dtype=dtype, count=count, offset=section['offset'])
+        return array.reshape(section['shape'])
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(path)
+
+    def __len__(self) -> int:
+        return self.meta['count']
+
+    @property
+    def dataset_version(self) -> Optional[str]:
+        return self.meta.get('dataset_version')
+
+    def _position(self, listing_id: int) -> Optional[int]:
+        pos = int(np.searchsorted(self.ids, listing_id))
+        if pos < len(self.ids) and self.ids[pos] == listing_id:
+            return pos
+        return None
+
+    def _row(self, pos: int, fields: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+        start, end = int(self.payload_offsets[pos]), int(self.payload_offsets[pos + 1])
+        properties = json.loads(self.payload[start:end].tobytes())
+        if fields:
+            properties = {field: properties[field] for field in dict.fromkeys(fields)}
+        return {'id': int(self.ids[pos]), **properties}
+
+    def get_row(self, listing_id: int) -> Optional[Dict[str, Any]]:
+        pos = self._position(listing_id)
+        return self._row(pos) if pos is not None else None
+
+    def get_rows(self, listing_ids: Sequence[int], fields: Optional[Sequence[str]] = None) -> List[Dict[str, Any]]:
+        '''
+        Returns rows in the order of `listing_ids`, skipping unknown ids
+        '''
+        rows = []
+        for listing_id in listing_ids:
+            pos = self._position(listing_id)
+            if pos is not None:
+                rows.append(self._row(pos, fields))
+        return rows
+
+    def get_all(self, skip: int = 0, limit: int = 10) -> List[Dict[str, Any]]:
+        return [self._row(pos) for pos in range(skip, min(skip + limit, len(self.ids)))]
+
+    def get_listings_in_cluster(self, listing_id: int, skip: int = 0, limit: int = 100) -> Optional[List[int]]:
+        pos = self._position(listing_id)
+        if pos is None:
+            return None
+        cluster = self.clusters[pos]
+        if cluster == -1:
+            return [listing_id] if skip == 0 and limit > 0 else []
+        c = int(np.searchsorted(self.cluster_keys, cluster))
+        if c >= len(self.cluster_keys) or self.cluster_keys[c] != cluster:
+            return []
+        start = int(self.cluster_offsets[c]) + skip
+        end = min(start + limit, int(self.cluster_offsets[c + 1]))
+        return [int(i) for i in self.cluster_members[start:end]]
+
+    def search_by_id(self, listing_id: int, k: int) -> Optional[List[Tuple[int, float]]]:
+        pos = self._position(listing_id)
+        if pos is None:
+            return None
+        return [
+            (int(i), float(s))
+            for i, s in zip(self.neighbour_ids[pos, :k], self.neighbour_scores[pos, :k]) if i != -1
+        ]
+
+    def search_by_ids(self, listing_ids: List[int], k: int) -> Dict[int, List[Tuple[int, float]]]:
+        results = {}
+        for listing_id in listing_ids:
+            neighbours = self.search_by_id(listing_id, k)
+            if neighbours is not None:
+                results[int(listing_id)] = neighbours
+        return results
@@ -0,0 +1,323 @@
+import os
+import json
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.core.database.vector_store import VectorStore, write_npy
+
+IVF_META_FILE = 'ivf_meta.json'
+IVF_CENTROIDS_FILE = 'ivf_centroids.npy'
+IVF_OFFSETS_FILE = 'ivf_offsets.npy'
+IVF_ROWS_FILE = 'ivf_rows.npy'
+IVF_VECTORS_FILE = 'ivf_vectors.npy'
+
+
+def _top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Returns the positions and values of the k highest scores of every row, best first
+    '''
+    k = min(k, scores.shape[1])
+    if k == 0:
+        empty = np.empty((scores.shape[0], 0))
+        return empty.astype(np.int64), empty.astype(np.float32)
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind='stable')
+    return np.take_along_axis(part, order, axis=1), np.take_along_axis(part_scores, order, axis=1)
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class VectorIndex(ABC):
+    """
+    Cosine k-NN over a vector store matrix. Stored vectors are L2 normalized, so the dot
+    product of a normalized query with a row is its cosine similarity.
+    """
+    def __init__(self, store: VectorStore, name: str = 'average'):
+        self.store = store
+        self.name = name
+
+    @abstractmethod
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        Returns (rows, scores), both of shape (q, k), for a batch of query vectors. Backends
+        that find fewer than k rows pad with row -1 and score -inf
+        '''
+
+    def search_by_id(self, listing_id: int, k: int) -> Optional[List[Tuple[int, float]]]:
+        '''
+        Returns the k nearest listings to a stored listing as (id, cosine score) pairs,
+        excluding the listing itself, or None when the listing has no vector
+        '''
+        row = self.store.row(listing_id)
+        if row is None:
+            return None
+        query = self.store.matrix(self.name)[row]
+        rows, scores = self.search(query, k + 1)
+        neighbours = [
+            (int(self.store.ids[r]), float(s))
+            for r, s in zip(rows[0], scores[0]) if r != row and r >= 0
+        ]
+        return neighbours[:k]
+
+    def search_by_vector(self, vector: np.ndarray, k: int) -> List[Tuple[int, float]]:
+        '''
+        Returns the k nearest listings to a query vector as (id, cosine score) pairs
+        '''
+        rows, scores = self.search(_normalize(vector), k)
+        return [(int(self.store.ids[r]), float(s)) for r, s in zip(rows[0], scores[0]) if r >= 0]
+
+    def search_rows(self, query: np.ndarray, k: int, rows: np.ndarray,
+                    block_size: int = 65536) -> Tuple[np.ndarray, np.ndarray]:
+        '''
+        Exact search restricted to `rows`: only their vectors are read and scored. Returns
+        (rows, scores) of the k best, best first
+        '''
+        query = _normalize(query)[0]
+        matrix = self.store.matrix(self.name)
+        best_rows = np.empty(0, dtype=np.int64)
+        best_scores = np.empty(0, dtype=np.float32)
+        for start in range(0, len(rows), block_size):
+            block_rows = np.asarray(rows[start:start + block_size], dtype=np.int64)
+            scores = np.asarray(matrix[block_rows], dtype=np.float32) @ query
+            candidate_rows = np.concatenate([best_rows, block_rows])
+            candidate_scores = np.concatenate([best_scores, scores])
+            keep, best = _top_k(candidate_scores[None, :], k)
+            best_rows, best_scores = candidate_rows[keep[0]], best[0]
+        return best_rows, best_scores
+
+    def search_filtered(self, query: np.ndarray, k: int, rows: np.ndarray, exclude_row: Optional[int] = None,
+                        prefilter_rows: int = 10000, oversample: float = 1.5) -> List[Tuple[int, float]]:
+        '''
+        Returns the k nearest listings among the sorted store `rows` that pass a filter, as
+        (id, cosine score) pairs.
+
+        When few rows match, only those are scored (pre-filtering). Otherwise the index is
+        searched for as many candidates as should hold k matches given the share of rows
+        that match, doubling until they do (post-filtering), so a filter matching most
+        listings costs about as much as an unfiltered query. Falls back to pre-filtering
+        when the index runs out of candidates.
+        '''
+        rows = np.asarray(rows, dtype=np.int64)
+        if exclude_row is not None:
+            rows = rows[rows != exclude_row]
+        if len(rows) == 0:
+            return []
+
+        if len(rows) > prefilter_rows:
+            n = len(self.store)
+            candidates = int(np.ceil((k + 1) / (len(rows) / n) * oversample))
+            while True:
+                candidates = min(candidates, n)
+                found, scores = self.search(query, candidates)
+                found, scores = found[0], scores[0]
+                valid = found >= 0
+                pos = np.minimum(np.searchsorted(rows, found), len(rows) - 1)
+                hit = valid & (rows[pos] == found)
+                if hit.sum() >= k:
+                    return [(int(self.store.ids[r]), float(s)) for r, s in zip(found[hit][:k], scores[hit][:k])]
+                if valid.sum() < candidates or candidates == n:
+                    break
+                candidates *= 2
+
+        found, scores = self.search_rows(query, k, rows)
+        return [(int(self.store.ids[r]), float(s)) for r, s in zip(found, scores)]
+
+    def search_by_ids(self, listing_ids: List[int], k: int) -> Dict[int, List[Tuple[int, float]]]:
+        '''
+        Batched `search_by_id`: one search call for every stored listing in `listing_ids`.
+        Listings without a vector are left out of the result
+        '''
+        rows = self.store.rows(listing_ids)
+        found = rows >= 0
+        query_ids = np.asarray(listing_ids, dtype=np.int64)[found]
+        query_rows = rows[found]
+        if len(query_rows) == 0:
+            return {}
+
+        queries = np.asarray(self.store.matrix(self.name)[query_rows], dtype=np.float32)
+        result_rows, result_scores = self.search(queries, k + 1)
+
+        results = {}
+        for listing_id, row, neighbour_rows, scores in zip(query_ids, query_rows, result_rows, result_scores):
+            results[int(listing_id)] = [
+                (int(self.store.ids[r]), float(s))
+                for r, s in zip(neighbour_rows, scores) if r != row and r >= 0
+            ][:k]
+        return results
+
+
+class BruteForceIndex(VectorIndex):
+    """
+    Exact search: one blocked matmul pass over the memory mapped matrix, keeping a running
+    top-k so memory stays bounded by the block size.
+    """
+    def __init__(self, store: VectorStore, name: str = 'average', block_size: int = 65536):
+        super().__init__(store, name)
+        self.block_size = block_size
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        queries = _normalize(queries)
+        matrix = self.store.matrix(self.name)
+        best_rows = np.empty((len(queries), 0), dtype=np.int64)
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+
+        for start in range(0, matrix.shape[0], self.block_size):
+            block = np.asarray(matrix[start:start + self.block_size], dtype=np.float32)
+            rows, scores = _top_k(queries @ block.T, k)
+            rows = np.concatenate([best_rows, rows + start], axis=1)
+            scores = np.concatenate([best_scores, scores], axis=1)
+            keep, best_scores = _top_k(scores, k)
+            best_rows = np.take_along_axis(rows, keep, axis=1)
+
+        return best_rows, best_scores
+
+
+class IVFIndex(VectorIndex):
+    """
+    Approximate search with an inverted file: rows are bucketed by their nearest k-means
+    centroid and a query only scores the `nprobe` closest buckets. Vectors are stored again
+    in bucket order so every probed bucket is one contiguous slice of the memory map.
+    """
+    def __init__(self, store: VectorStore, name: str = 'average', nprobe: int = 16):
+        super().__init__(store, name)
+        self.nprobe = nprobe
+        path = store.path
+        with open(os.path.join(path, IVF_META_FILE)) as f:
+            self.meta = json.load(f)
+        self.centroids = np.load(os.path.join(path, IVF_CENTROIDS_FILE))
+        self.offsets = np.load(os.path.join(path, IVF_OFFSETS_FILE))
+        self.list_rows = np.load(os.path.join(path, IVF_ROWS_FILE), mmap_mode='r')
+        self.list_vectors = np.load(os.path.join(path, IVF_VECTORS_FILE), mmap_mode='r')
+
+    @staticmethod
+    def exists(path: str, name: str = 'average') -> bool:
+        meta_path = os.path.join(path, IVF_META_FILE)
+        if not os.path.exists(meta_path):
+            return False
+        with open(meta_path) as f:
+            return json.load(f).get('name') == name
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        queries = _normalize(queries)
+        nprobe = min(self.nprobe, len(self.centroids))
+        probes, _ = _top_k(queries @ self.centroids.T, nprobe)
+
+        all_rows = np.full((len(queries), k), -1, dtype=np.int64)
+        all_scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for i, query in enumerate(queries):
+            positions = np.concatenate([
+                np.arange(self.offsets[p], self.offsets[p + 1]) for p in probes[i]
+            ])
+            if len(positions) == 0:
+                continue
+            vectors = np.concatenate([
+                self.list_vectors[self.offsets[p]:self.offsets[p + 1]] for p in probes[i]
+            ]).astype(np.float32, copy=False)
+            top, scores = _top_k((vectors @ query)[None, :], k)
+            all_rows[i, :top.shape[1]] = self.list_rows[positions[top[0]]]
+            all_scores[i, :top.shape[1]] = scores[0]
+
+        return all_rows, all_scores
+
+
+
+def _spherical_kmeans(sample: np.ndarray, n_lists: int, n_iter: int, seed: int, block_size: int = 65536) -> np.ndarray:
+    '''
+    Trains unit norm centroids with Lloyd iterations on the cosine metric
+    '''
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = _assign(sample, centroids, block_size)
+        counts = np.bincount(assign, minlength=n_lists)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = np.zeros_like(centroids)
+        empty = counts == 0
+        sums[~empty] = np.add.reduceat(sample[np.argsort(assign, kind='stable')], starts[~empty], axis=0)
+        if empty.any():
+            sums[empty] = sample[rng.choice(len(sample), int(empty.sum()), replace=False)]
+        centroids = _normalize(sums)
+    return centroids
+
+
+def _assign(matrix: np.ndarray, centroids: np.ndarray, block_size: int = 65536) -> np.ndarray:
+    assign = np.empty(len(matrix), dtype=np.int64)
+    for start in range(0, len(matrix), block_size):
+        block = np.asarray(matrix[start:start + block_size], dtype=np.float32)
+        assign[start:start + block_size] = np.argmax(block @ centroids.T, axis=1)
+    return assign
+
+
+def build_ivf_index(store: VectorStore, name: str = 'average', n_lists: Optional[int] = None,
+                    n_iter: int = 20, sample_size: int = 262144, seed: int = 0) -> None:
+    '''
+    Trains the IVF centroids on a sample of the store and writes the bucketed copy of the
+    vectors next to it
+    '''
+    matrix = store.matrix(name)
+    n = matrix.shape[0]
+    if n == 0:
+        return
+    n_lists = n_lists or max(1, int(4 * np.sqrt(n)))
+    n_lists = min(n_lists, n)
+
+    rng = np.random.default_rng(seed)
+    sample_rows = np.sort(rng.choice(n, min(n, max(sample_size, n_lists)), replace=False))
+    sample = np.asarray(matrix[sample_rows], dtype=np.float32)
+    centroids = _spherical_kmeans(sample, n_lists, n_iter, seed)
+
+    _write_ivf_index(store, name, centroids, _assign(matrix, centroids))
+
+
+def _write_ivf_index(store: VectorStore, name: str, centroids: np.ndarray, assign: np.ndarray) -> None:
+    '''
+    Writes the buckets of every store row given its centroid assignment
+    '''
+    n_lists = len(centroids)
+    rows = np.argsort(assign, kind='stable')
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=n_lists))]).astype(np.int64)
+
+    path = store.path
+    write_npy(os.path.join(path, IVF_CENTROIDS_FILE), centroids.astype(np.float32))
+    write_npy(os.path.join(path, IVF_OFFSETS_FILE), offsets)
+    write_npy(os.path.join(path, IVF_ROWS_FILE), rows.astype(np.int64))
+    write_npy(os.path.join(path, IVF_VECTORS_FILE), np.asarray(store.matrix(name)[rows]))
+    with open(os.path.join(path, IVF_META_FILE), 'w') as f:
+        json.dump({'name': name, 'n_lists': int(n_lists), 'count': int(len(store))}, f, indent=2)
+
+
+def update_ivf_index(store: VectorStore, previous: IVFIndex, changed_ids: np.ndarray, name: str = 'average') -> None:
+    '''
+    Re-buckets the IVF index after an incremental vector store update without retraining the
+    centroids: listings whose vector is unchanged keep their bucket, new and changed listings
+    go to their nearest centroid. `previous` is the index opened before the update, whose
+    memory maps still see the replaced files.
+    '''
+    previous_assign = np.empty(len(previous.list_rows), dtype=np.int64)
+    previous_assign[previous.list_rows] = np.repeat(np.arange(len(previous.centroids)), np.diff(previous.offsets))
+
+    previous_rows = previous.store.rows(store.ids)
+    kept = (previous_rows >= 0) & ~np.isin(store.ids, changed_ids)
+    assign = np.full(len(store), -1, dtype=np.int64)
+    assign[kept] = previous_assign[previous_rows[kept]]
+    reassign = np.flatnonzero(~kept)
+    if len(reassign):
+        assign[reassign] = _assign(store.matrix(name)[reassign], previous.centroids)
+    _write_ivf_index(store, name, previous.centroids, assign)
+
+
+def load_vector_index(store: VectorStore, backend: str = 'ivf', nprobe: int = 16, name: str = 'average') -> VectorIndex:
+    '''
+    Returns the configured index backend, falling back to exact search when no IVF index
+    has been built for the store
+    '''
+    if backend == 'ivf' and IVFIndex.exists(store.path, name):
+        return IVFIndex(store, name, nprobe=nprobe)
+    return BruteForceIndex(store, name)
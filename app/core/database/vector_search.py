@@ -0,0 +1,166 @@
+import os
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from loguru import logger
+
+from app.core.database.vector_store import VectorStore
+from app.core.database.vector_index import load_vector_index
+from app.core.database.listing_features import ListingFeatures
+
+
+class VectorSearch:
+    """
+    The vector store, k-NN index and listing features of one build. Requests read all three
+    from the same VectorSearch, so they never mix the rows of two builds.
+    """
+    def __init__(self, store: Optional[VectorStore], index, features: Optional[ListingFeatures] = None):
+        self.store = store
+        self.index = index
+        self.features = features
+
+    @staticmethod
+    def open(path: str, backend: str = 'ivf', nprobe: int = 16) -> Optional['VectorSearch']:
+        '''
+        Opens the build at `path`, None when there is no vector store
+        '''
+        if not VectorStore.exists(path):
+            return None
+        store = VectorStore(path)
+        index = load_vector_index(store, backend=backend, nprobe=nprobe)
+        features = ListingFeatures(store) if ListingFeatures.exists(path) else None
+        return VectorSearch(store, index, features)
+
+    @property
+    def dataset_version(self) -> Optional[str]:
+        # Listing features are written last by `make create_db`, their stamp dates the whole build
+        return self.features.dataset_version if self.features else None
+
+    @property
+    def dimension(self) -> Optional[int]:
+        return self.store.matrix('average').shape[1] if self.store else None
+
+    def for_listing(self, listing_id: int) -> Optional['VectorSearch']:
+        '''
+        Returns the VectorSearch holding the listing's vectors
+        '''
+        return self
+
+    def search_by_ids(self, listing_ids: List[int], k: int) -> Dict[int, List[Tuple[int, float]]]:
+        return self.index.search_by_ids(listing_ids, k)
+
+    def search_by_vector(self, vector, k: int) -> List[Tuple[int, float]]:
+        return self.index.search_by_vector(vector, k)
+
+    def describe(self) -> str:
+        return f"{len(self.store)} listings, {type(self.index).__name__}" + (
+            "" if self.features else ", no listing features"
+        )
+
+
+class MarketVectorSearch(VectorSearch):
+    """
+    One VectorSearch per market of a multi-market build, each opened from the vector store
+    next to its market database. A listing is searched within its own market (the store whose
+    sorted ids hold it), batches are split by market, and vector queries search every market
+    and keep the k best.
+
+    It has no features of its own: the market index is stamped once every market is built,
+    so a new stamp already means complete files.
+    """
+    def __init__(self, markets: Dict[str, VectorSearch]):
+        super().__init__(None, None)
+        self.markets = markets
+
+    @staticmethod
+    def open(market_db_paths: Dict[str, str], backend: str = 'ivf', nprobe: int = 16) -> Optional['MarketVectorSearch']:
+        '''
+        Opens the vector store of every market in {market: database path}, None when no
+        market has one
+        '''
+        markets = {}
+        for name, db_path in market_db_paths.items():
+            path = os.path.splitext(db_path)[0] + '_vectors'
+            search = VectorSearch.open(path, backend=backend, nprobe=nprobe)
+            if search:
+                markets[name] = search
+            else:
+                logger.warning(f"No vector store found at {path} for market {name}, its listings can't be searched")
+        return MarketVectorSearch(markets) if markets else None
+
+    @property
+    def dimension(self) -> Optional[int]:
+        return next(iter(self.markets.values())).dimension
+
+    def for_listing(self, listing_id: int) -> Optional[VectorSearch]:
+        for search in self.markets.values():
+            if search.store.row(listing_id) is not None:
+                return search
+        return None
+
+    def search_by_ids(self, listing_ids: List[int], k: int) -> Dict[int, List[Tuple[int, float]]]:
+        results = {}
+        for search in self.markets.values():
+            market_ids = [id for id, row in zip(listing_ids, search.store.rows(listing_ids)) if row >= 0]
+            if market_ids:
+                results.update(search.search_by_ids(market_ids, k))
+        return results
+
+    def search_by_vector(self, vector, k: int) -> List[Tuple[int, float]]:
+        neighbours = [n for search in self.markets.values() for n in search.search_by_vector(vector, k)]
+        return sorted(neighbours, key=lambda n: n[1], reverse=True)[:k]
+
+    def describe(self) -> str:
+        return ", ".join(f"{name}: {search.describe()}" for name, search in self.markets.items())
+
+
+class VectorSearchReloader:
+    """
+    Reopens the vector search files after `make create_db` or `make update_db`. A background
+    thread polls the dataset version stamp of the database every `check_seconds`, as the
+    listing cache does, and once the listing features carry the new stamp (the build is
+    complete) opens the new files and hands them to `on_reload`. Requests in flight keep the
+    VectorSearch they started with, whose memory maps outlive the replaced files.
+    """
+    def __init__(self, open_search: Callable[[], Optional[VectorSearch]], get_version: Callable[[], Optional[str]],
+                 on_reload: Callable[[VectorSearch], None], version: Optional[str], check_seconds: float = 30.0):
+        self.open_search = open_search
+        self.get_version = get_version
+        self.on_reload = on_reload
+        self.version = version
+        self.check_seconds = check_seconds
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='vector-search-reloader', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.check_seconds):
+            try:
+                self.check()
+            except Exception as err:
+                logger.warning(f"Couldn't reload the vector search files, retrying: {err}")
+
+    def check(self) -> bool:
+        '''
+        Reloads if the dataset version changed and the new build is complete, returns whether it did
+        '''
+        version = self.get_version()
+        if version == self.version:
+            return False
+        search = self.open_search()
+        if search is None:
+            return False
+        if search.features is not None and search.dataset_version != version:
+            # The database is swapped in before the listing features are written
+            return False
+        self.version = version
+        self.on_reload(search)
+        logger.info(f"Reloaded the vector search files for dataset version {version} ({search.describe()})")
+        return True
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
@@ -0,0 +1,164 @@
+import os
+import json
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+IDS_FILE = 'ids.npy'
+META_FILE = 'meta.json'
+SUPPORTED_DTYPES = ('float32', 'float16')
+
+
+def default_vector_store_path() -> str:
+    '''
+    Returns the configured vector store directory, defaulting to a sibling of the DB file
+    '''
+    path = os.getenv('VECTOR_STORE_PATH')
+    if path:
+        return path
+    return os.path.splitext(os.getenv('DB_PATH'))[0] + '_vectors'
+
+
+def write_npy(path: str, array: np.ndarray) -> None:
+    '''
+    Writes an array next to its final location and renames it into place, so a reader never
+    maps a half written file
+    '''
+    tmp_path = path + '.tmp'
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=array.dtype, shape=array.shape)
+    out[:] = array
+    out.flush()
+    del out
+    os.replace(tmp_path, path)
+
+
+def save_vector_store(path: str, ids: Sequence[int], matrices: Dict[str, np.ndarray], dtype: str = 'float32') -> None:
+    '''
+    Persists one or more (n, d) embedding matrices keyed by listing id.
+
+    Rows are sorted by id so the id -> row lookup is a binary search over `ids.npy`, and every
+    matrix is written as a contiguous .npy file that readers memory map.
+    '''
+    if dtype not in SUPPORTED_DTYPES:
+        raise ValueError(f"Unsupported vector store dtype: {dtype}")
+
+    ids = np.asarray(ids, dtype=np.int64)
+    order = np.argsort(ids, kind='stable')
+    sorted_ids = ids[order]
+    if len(sorted_ids) > 1 and np.any(sorted_ids[1:] == sorted_ids[:-1]):
+        raise ValueError("Duplicate listing ids in vector store input")
+
+    os.makedirs(path, exist_ok=True)
+    meta = {'count': int(len(sorted_ids)), 'dtype': dtype, 'matrices': {}}
+    for name, matrix in matrices.items():
+        matrix = np.asarray(matrix)
+        if matrix.ndim != 2 or matrix.shape[0] != len(sorted_ids):
+            raise ValueError(f"Matrix '{name}' must have shape (n, d) with n={len(sorted_ids)}")
+        write_npy(os.path.join(path, f'{name}.npy'), np.ascontiguousarray(matrix[order], dtype=dtype))
+        meta['matrices'][name] = {'dim': int(matrix.shape[1])}
+
+    write_npy(os.path.join(path, IDS_FILE), sorted_ids)
+    with open(os.path.join(path, META_FILE + '.tmp'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(os.path.join(path, META_FILE + '.tmp'), os.path.join(path, META_FILE))
+
+
+def update_vector_store(path: str, ids: Sequence[int], matrices: Dict[str, np.ndarray],
+                        deleted_ids: Sequence[int] = (), out_path: Optional[str] = None) -> None:
+    '''
+    Replaces or adds the rows of `ids` and drops the rows of `deleted_ids`, without touching
+    the vectors of any other listing. Every matrix of the store must be given for `ids`.
+    Matrices are rewritten one at a time, so memory stays bounded by a single matrix.
+    The updated store is written to `out_path` when given, leaving the one at `path` as it was.
+    '''
+    store = VectorStore(path)
+    path = out_path or path
+    os.makedirs(path, exist_ok=True)
+    ids = np.asarray(ids, dtype=np.int64)
+    missing = set(store.names) - set(matrices)
+    if missing:
+        raise ValueError(f"Missing matrices for the vector store update: {sorted(missing)}")
+
+    keep = ~np.isin(store.ids, np.concatenate([ids, np.asarray(deleted_ids, dtype=np.int64)]))
+    merged_ids = np.concatenate([store.ids[keep], ids])
+    order = np.argsort(merged_ids, kind='stable')
+    sorted_ids = merged_ids[order]
+    if len(sorted_ids) > 1 and np.any(sorted_ids[1:] == sorted_ids[:-1]):
+        raise ValueError("Duplicate listing ids in vector store input")
+
+    for name in store.names:
+        matrix = np.concatenate([store.matrix(name)[keep], np.asarray(matrices[name], dtype=store.dtype)])
+        write_npy(os.path.join(path, f'{name}.npy'), np.ascontiguousarray(matrix[order]))
+        del matrix
+
+    write_npy(os.path.join(path, IDS_FILE), sorted_ids)
+    meta = dict(store.meta, count=int(len(sorted_ids)))
+    with open(os.path.join(path, META_FILE + '.tmp'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(os.path.join(path, META_FILE + '.tmp'), os.path.join(path, META_FILE))
+
+
+class VectorStore:
+    """
+    Read-only, memory mapped view over the embeddings written by `save_vector_store`.
+    Opening is O(1): nothing is parsed or copied until rows are touched.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+
+        self.dtype = np.dtype(self.meta['dtype'])
+        self.ids = np.load(os.path.join(path, IDS_FILE), mmap_mode='r')
+        self._matrices = {
+            name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+            for name in self.meta['matrices']
+        }
+
+    @staticmethod
+    def exists(path: str) -> bool:
+        return os.path.exists(os.path.join(path, META_FILE))
+
+    def __len__(self) -> int:
+        return self.meta['count']
+
+    @property
+    def names(self) -> List[str]:
+        return list(self._matrices)
+
+    def matrix(self, name: str = 'average') -> np.ndarray:
+        '''
+        Returns the memory mapped (n, d) matrix for an embedding field
+        '''
+        return self._matrices[name]
+
+    def row(self, listing_id: int) -> Optional[int]:
+        '''
+        Returns the row of a listing, or None when it has no stored vector
+        '''
+        pos = int(np.searchsorted(self.ids, listing_id))
+        if pos < len(self.ids) and self.ids[pos] == listing_id:
+            return pos
+        return None
+
+    def rows(self, listing_ids: Sequence[int]) -> np.ndarray:
+        '''
+        Vectorized id -> row lookup, missing ids are returned as -1
+        '''
+        listing_ids = np.asarray(listing_ids, dtype=np.int64)
+        pos = np.searchsorted(self.ids, listing_ids)
+        pos = np.minimum(pos, max(len(self.ids) - 1, 0))
+        found = len(self.ids) > 0 and self.ids[pos] == listing_ids
+        return np.where(found, pos, -1)
+
+    def vector(self, listing_id: int, name: str = 'average') -> Optional[np.ndarray]:
+        '''
+        Returns a float32 copy of a listing's vector
+        '''
+        pos = self.row(listing_id)
+        if pos is None:
+            return None
+        return np.asarray(self._matrices[name][pos], dtype=np.float32)
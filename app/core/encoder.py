@@ -0,0 +1,222 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from ml.features.build_features import (
+    EMBEDDING_FIELDS,
+    REVIEW_SCORE_SENTENCES,
+    apply_weighted_average,
+    construct_high_level_overview,
+    create_overview,
+    embedding_weights,
+    evaluate_listing,
+)
+
+# Listing attributes each text field is built from, a field is only encoded when the query
+# sets at least one of them
+FIELD_INPUTS = {
+    'property_outline': ['description', 'review_scores_rating'] + [column for column, *_ in REVIEW_SCORE_SENTENCES],
+    'description_summary': [
+        'property_type', 'room_type', 'price', 'bathrooms_text', 'bedrooms', 'beds', 'accommodates',
+        'neighbourhood_cleansed', 'review_scores_rating',
+    ],
+    'high_level_overview': ['property_type', 'description', 'neighborhood_overview'],
+}
+
+# Review scores of the outline a query leaves out: its overall rating, or the middle band
+# ("generally ...") of every sentence
+NEUTRAL_REVIEW_SCORE = 4.0
+
+
+def listing_texts(attributes: Dict[str, Any]) -> Dict[str, str]:
+    '''
+    Builds the text fields of a partial listing with the same templates as `make create_db`,
+    returning only the fields the attributes inform
+    '''
+    row = {column: np.nan for inputs in FIELD_INPUTS.values() for column in inputs}
+    row['neighborhood_overview'] = np.nan
+    row.update({key: value for key, value in attributes.items() if value is not None})
+    given = {key for key, value in attributes.items() if value is not None}
+
+    outline_row = dict(row)
+    rating = row['review_scores_rating']
+    for column, *_ in REVIEW_SCORE_SENTENCES:
+        if column not in given:
+            outline_row[column] = rating if 'review_scores_rating' in given else NEUTRAL_REVIEW_SCORE
+    if 'review_scores_rating' not in given:
+        outline_row['review_scores_rating'] = NEUTRAL_REVIEW_SCORE
+
+    builders = {
+        'property_outline': lambda: evaluate_listing(outline_row),
+        'description_summary': lambda: create_overview(row),
+        'high_level_overview': lambda: construct_high_level_overview(row),
+    }
+    return {field: builders[field]() for field in EMBEDDING_FIELDS if given & set(FIELD_INPUTS[field])}
+
+
+class EmbeddingBatcher:
+    """
+    Encodes texts for concurrent requests in shared forward passes. Requests queue their
+    texts and a single consumer task collects jobs until the batch holds `max_batch_size`
+    texts or `max_wait_ms` passed since its first job arrived, encodes them in one
+    `model.encode` call on a dedicated thread and hands each request its rows.
+
+    Queue depth, batch sizes, queueing and encoding times are kept for `stats`, the
+    distributions over the last `sample_size` batches.
+    """
+    def __init__(self, model, max_batch_size: int = 64, max_wait_ms: float = 5.0, sample_size: int = 1024):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.dimension = model.get_sentence_embedding_dimension()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='encoder')
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.batches = 0
+        self.jobs = 0
+        self.items = 0
+        self.errors = 0
+        self._batch_sizes: Deque[int] = deque(maxlen=sample_size)
+        self._wait_ms: Deque[float] = deque(maxlen=sample_size)
+        self._encode_ms: Deque[float] = deque(maxlen=sample_size)
+
+    async def encode(self, texts: List[str]) -> np.ndarray:
+        '''
+        Returns the normalized float32 (len(texts), d) embeddings of `texts`
+        '''
+        loop = asyncio.get_running_loop()
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = loop.create_task(self._consume())
+        future = loop.create_future()
+        self.queue_depth += len(texts)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        await self._queue.put((texts, future, loop.time()))
+        return await future
+
+    async def _next_batch(self) -> List[Tuple[List[str], asyncio.Future, float]]:
+        loop = asyncio.get_running_loop()
+        jobs = [await self._queue.get()]
+        size = len(jobs[0][0])
+        deadline = loop.time() + self.max_wait_ms / 1000
+        while size < self.max_batch_size:
+            if self._queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    job = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                job = self._queue.get_nowait()
+            jobs.append(job)
+            size += len(job[0])
+        return jobs
+
+    async def _consume(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            jobs = await self._next_batch()
+            texts = [text for job_texts, _, _ in jobs for text in job_texts]
+            started = loop.time()
+            self.queue_depth -= len(texts)
+            self.batches += 1
+            self.jobs += len(jobs)
+            self.items += len(texts)
+            self._batch_sizes.append(len(texts))
+            self._wait_ms.extend((started - enqueued) * 1000 for _, _, enqueued in jobs)
+            try:
+                vectors = await loop.run_in_executor(self._executor, self._encode, texts)
+            except Exception as err:
+                self.errors += 1
+                for _, future, _ in jobs:
+                    if not future.done():
+                        future.set_exception(err)
+                continue
+            finally:
+                self._encode_ms.append((loop.time() - started) * 1000)
+            start = 0
+            for job_texts, future, _ in jobs:
+                if not future.done():
+                    future.set_result(vectors[start:start + len(job_texts)])
+                start += len(job_texts)
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        return self.model.encode(
+            texts,
+            batch_size=self.max_batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+        ).astype(np.float32, copy=False)
+
+    @staticmethod
+    def _percentiles(samples: Deque[float]) -> Dict[str, Optional[float]]:
+        if not samples:
+            return {'p50': None, 'p99': None, 'max': None}
+        values = np.fromiter(samples, dtype=np.float64)
+        p50, p99 = np.percentile(values, [50, 99])
+        return {'p50': float(p50), 'p99': float(p99), 'max': float(values.max())}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'batches': self.batches,
+            'jobs': self.jobs,
+            'items': self.items,
+            'errors': self.errors,
+            'mean_batch_size': self.items / self.batches if self.batches else 0.0,
+            'batch_size': self._percentiles(self._batch_sizes),
+            'wait_ms': self._percentiles(self._wait_ms),
+            'encode_ms': self._percentiles(self._encode_ms),
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait_ms,
+        }
+
+    def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self._executor.shutdown(wait=True)
+
+
+class QueryEncoder:
+    """
+    Turns free text or a partial listing into a query vector in the space of the stored
+    average embeddings.
+    """
+    def __init__(self, batcher: EmbeddingBatcher, weights: Optional[List[float]] = None):
+        self.batcher = batcher
+        self.weights = dict(zip(EMBEDDING_FIELDS, weights or embedding_weights()))
+
+    async def encode(self, text: Optional[str] = None,
+                     attributes: Optional[Dict[str, Any]] = None) -> np.ndarray:
+        '''
+        Returns the normalized query vector. Listing
+        fields are combined with the EMBEDDING_WEIGHTS of the fields the attributes inform,
+        and free text counts as much as all of them together
+        '''
+        fields = {
+            field: field_text for field, field_text in listing_texts(attributes or {}).items() if self.weights[field] > 0
+        }
+        texts = list(fields.values()) + ([text] if text else [])
+        if not texts:
+            raise ValueError("Pass a text or at least one listing attribute")
+        vectors = await self.batcher.encode(texts)
+
+        parts = []
+        if fields:
+            weights = [self.weights[field] for field in fields]
+            parts.append(apply_weighted_average(vectors[None, :len(fields)], weights)[0])
+        if text:
+            parts.append(vectors[-1])
+        query = np.mean(parts, axis=0)
+        query /= max(float(np.linalg.norm(query)), 1e-12)
+        return query.astype(np.float32)
@@ -1,8 +1,164 @@
 from typing import Callable
 
 from fastapi import FastAPI
+from loguru import logger
+
+from core.config import (
+    CACHE_ENABLED,
+    CACHE_MAX_ENTRIES,
+    CACHE_MAX_BYTES,
+    CACHE_TTL_SECONDS,
+    CACHE_VERSION_CHECK_SECONDS,
+    DB_PATH,
+    DB_EXECUTOR_WORKERS,
+    MAX_CONNECTIONS_COUNT,
+    MIN_CONNECTIONS_COUNT,
+    MARKET_MIN_CONNECTIONS,
+    SQLITE_MMAP_SIZE,
+    SQLITE_CACHE_SIZE_KIB,
+    VECTOR_STORE_PATH,
+    VECTOR_INDEX_BACKEND,
+    IVF_NPROBE,
+    VECTOR_RELOAD_CHECK_SECONDS,
+    LISTING_BACKEND,
+    SNAPSHOT_PATH,
+    QUERY_ENCODER_ENABLED,
+    SENTENCE_TRANSFORMER_MODEL,
+    QUERY_BATCH_SIZE,
+    QUERY_BATCH_WAIT_MS,
+)
+from app.core.database.db import AirbnbDatabase, ConnectionPool, set_default_database
+from app.core.database.executor import DatabaseExecutor
+from app.core.database.markets import MarketRouter, has_market_index, get_market_router, market_paths, set_market_router
+from app.core.cache import LRUCache
+from app.core.database.snapshot import ListingSnapshot
+from app.models.airbnb_listing_db import ListingCache, get_dataset_version, set_listing_cache, set_listing_snapshot
+from app.core.database.vector_search import MarketVectorSearch, VectorSearch, VectorSearchReloader
 
 
 def create_start_app_handler(app: FastAPI) -> Callable:
     def start_app() -> None:
-        return start_app
+        app.state.db_executor = DatabaseExecutor(max_workers=DB_EXECUTOR_WORKERS)
+        app.state.db = None
+
+        if LISTING_BACKEND == "snapshot":
+            snapshot = ListingSnapshot(SNAPSHOT_PATH)
+            set_listing_snapshot(snapshot)
+            logger.info(f"Serving listings from snapshot {SNAPSHOT_PATH} ({len(snapshot)} listings)")
+        else:
+            pool = ConnectionPool(
+                DB_PATH,
+                min_size=MIN_CONNECTIONS_COUNT,
+                max_size=MAX_CONNECTIONS_COUNT,
+                read_only=True,
+                mmap_size=SQLITE_MMAP_SIZE,
+                cache_size_kib=SQLITE_CACHE_SIZE_KIB,
+            )
+            app.state.db = AirbnbDatabase(DB_PATH, pool=pool)
+            set_default_database(app.state.db)
+            logger.info(f"Opened {MIN_CONNECTIONS_COUNT} connections to {DB_PATH}")
+
+            if has_market_index(app.state.db):
+                router = MarketRouter(
+                    app.state.db,
+                    min_connections=MARKET_MIN_CONNECTIONS,
+                    max_connections=MAX_CONNECTIONS_COUNT,
+                    mmap_size=SQLITE_MMAP_SIZE,
+                    cache_size_kib=SQLITE_CACHE_SIZE_KIB,
+                )
+                set_market_router(router)
+                logger.info(f"Routing listings to {len(router.markets)} markets ({len(router)} listings)")
+
+            if CACHE_ENABLED:
+                # Split the byte budget between listing rows and cluster pages
+                set_listing_cache(ListingCache(
+                    LRUCache(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES * 3 // 4, CACHE_TTL_SECONDS),
+                    LRUCache(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES // 4, CACHE_TTL_SECONDS),
+                    version_check_seconds=CACHE_VERSION_CHECK_SECONDS,
+                ))
+
+        markets = get_market_router() is not None
+
+        def open_vector_search():
+            if markets:
+                # Every market's vector store sits next to its database
+                return MarketVectorSearch.open(
+                    market_paths(app.state.db), backend=VECTOR_INDEX_BACKEND, nprobe=IVF_NPROBE
+                )
+            return VectorSearch.open(VECTOR_STORE_PATH, backend=VECTOR_INDEX_BACKEND, nprobe=IVF_NPROBE)
+
+        app.state.vector_search = open_vector_search()
+        if app.state.vector_search:
+            logger.info(f"Opened vector search ({app.state.vector_search.describe()})")
+            if app.state.vector_search.features is None and not markets:
+                logger.warning(f"No listing features found at {VECTOR_STORE_PATH}, /similar filters are disabled")
+        elif markets:
+            logger.warning("No market has a vector store, run `make create_markets_db` to build them")
+        else:
+            logger.warning(f"No vector store found at {VECTOR_STORE_PATH}, run `make create_db` to build it")
+
+        def on_reload(search):
+            if markets:
+                # A rebuild can add or drop markets and changes their listing counts
+                set_market_router(get_market_router().reopen())
+            app.state.vector_search = search
+
+        app.state.vector_reloader = None
+        if app.state.db and VECTOR_RELOAD_CHECK_SECONDS > 0:
+            # Reopen the vector store (and the market router) once a refresh stamps a new dataset version
+            app.state.vector_reloader = VectorSearchReloader(
+                open_vector_search,
+                lambda: get_dataset_version(app.state.db),
+                on_reload,
+                version=get_dataset_version(app.state.db),
+                check_seconds=VECTOR_RELOAD_CHECK_SECONDS,
+            )
+            app.state.vector_reloader.start()
+
+        if LISTING_BACKEND == "snapshot" and app.state.vector_search is None:
+            # Fall back to the precomputed neighbours shipped in the snapshot
+            app.state.vector_search = VectorSearch(None, snapshot)
+
+        app.state.query_encoder = None
+        if QUERY_ENCODER_ENABLED and app.state.vector_search and app.state.vector_search.dimension:
+            # Imported here so deployments without query-by-text search never load torch
+            from app.core.encoder import EmbeddingBatcher, QueryEncoder
+            from ml.features.build_features import load_model
+
+            # Loaded once here rather than on the first search request
+            batcher = EmbeddingBatcher(
+                load_model(SENTENCE_TRANSFORMER_MODEL), max_batch_size=QUERY_BATCH_SIZE, max_wait_ms=QUERY_BATCH_WAIT_MS
+            )
+            dimension = app.state.vector_search.dimension
+            if batcher.dimension == dimension:
+                app.state.query_encoder = QueryEncoder(batcher)
+                logger.info(f"Loaded {SENTENCE_TRANSFORMER_MODEL} for query-by-text search")
+            else:
+                batcher.close()
+                logger.warning(
+                    f"{SENTENCE_TRANSFORMER_MODEL} embeds into {batcher.dimension} dimensions but the vector "
+                    f"store has {dimension}, query-by-text search is disabled"
+                )
+
+    return start_app
+
+
+def create_stop_app_handler(app: FastAPI) -> Callable:
+    def stop_app() -> None:
+        if app.state.vector_reloader:
+            app.state.vector_reloader.stop()
+        app.state.db_executor.shutdown()
+        if app.state.query_encoder:
+            app.state.query_encoder.batcher.close()
+        set_listing_cache(None)
+        set_listing_snapshot(None)
+        set_default_database(None)
+        router = get_market_router()
+        if router:
+            set_market_router(None)
+            router.close()
+        if app.state.db:
+            app.state.db.close_connection()
+            logger.info("Closed database connections")
+
+    return stop_app
@@ -1,15 +1,14 @@
 from fastapi import FastAPI
 
 from api.routes.api import router as api_router
-from core.events import create_start_app_handler
+from core.events import create_start_app_handler, create_stop_app_handler
 from core.config import API_PREFIX, DEBUG, PROJECT_NAME, VERSION
 
 def get_application() -> FastAPI:
     application = FastAPI(title=PROJECT_NAME, debug=DEBUG, version=VERSION)
     application.include_router(api_router, prefix=API_PREFIX)
-    pre_load = False
-    if pre_load:
-        application.add_event_handler("startup", create_start_app_handler(application))
+    application.add_event_handler("startup", create_start_app_handler(application))
+    application.add_event_handler("shutdown", create_stop_app_handler(application))
 
     return application
 
@@ -3,8 +3,85 @@ import os, sys
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
 sys.path.insert(0, project_root)
 
-from typing import List, Dict, Optional
-from app.core.database.db import AirbnbDatabase
+import json
+import time
+import sqlite3
+from typing import Any, List, Dict, Optional, Sequence
+from app.core.cache import LRUCache, MISSING
+from app.core.database.db import AirbnbDatabase, get_default_database
+from app.core.database.listing_schema_utils import Listing
+from app.core.database.snapshot import ListingSnapshot
+from app.core.database.markets import get_market_router
+
+# Columns a caller may project, the id is always returned. Internal columns of the listing
+# table (the content hash incremental refreshes compare) aren't Listing fields and never served
+LISTING_FIELDS = [name for name in Listing.model_fields if name != 'id']
+
+def select_columns(fields: Optional[Sequence[str]] = None, table: str = 'listing') -> str:
+    """
+    Returns the SELECT list for a projection, rejecting anything that isn't a listing column.
+    Without fields every Listing field is selected
+    """
+    if not fields:
+        fields = LISTING_FIELDS
+    unknown = [field for field in fields if field not in LISTING_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown listing fields: {', '.join(unknown)}")
+    return ', '.join(f'{table}.{field}' for field in ['id'] + list(dict.fromkeys(fields)))
+
+def get_dataset_version(db: AirbnbDatabase) -> Optional[str]:
+    """
+    Returns the version stamp written by the last `make create_db`, if any
+    """
+    try:
+        row = db.fetch_data(
+            "SELECT value FROM dataset_meta WHERE key = 'dataset_version'", fetch_all=False
+        )
+    except sqlite3.OperationalError:
+        return None
+    return row['value'] if row else None
+
+class ListingCache:
+    """
+    Read-through caches for lookups on the default database. Listing data only changes when
+    the dataset is reloaded, so entries stay valid until the dataset version stamp changes,
+    which is polled at most every `version_check_seconds`.
+    """
+    def __init__(self, listings: LRUCache, clusters: LRUCache, version_check_seconds: float = 30.0):
+        self.listings = listings
+        self.clusters = clusters
+        self.version_check_seconds = version_check_seconds
+        self._checked_at = float('-inf')
+
+    def validate(self, db: AirbnbDatabase) -> None:
+        now = time.monotonic()
+        if now - self._checked_at < self.version_check_seconds:
+            return
+        self._checked_at = now
+        version = get_dataset_version(db)
+        self.listings.set_version(version)
+        self.clusters.set_version(version)
+
+    def stats(self) -> Dict[str, Any]:
+        return {'listing': self.listings.stats(), 'cluster': self.clusters.stats()}
+
+_listing_cache: Optional[ListingCache] = None
+
+def set_listing_cache(cache: Optional[ListingCache]) -> None:
+    global _listing_cache
+    _listing_cache = cache
+
+def get_listing_cache() -> Optional[ListingCache]:
+    return _listing_cache
+
+_listing_snapshot: Optional[ListingSnapshot] = None
+
+def set_listing_snapshot(snapshot: Optional[ListingSnapshot]) -> None:
+    """
+    Serves lookups that don't pass a database from a snapshot file instead of SQLite
+    """
+    global _listing_snapshot
+    _listing_snapshot = snapshot
 
 class AirbnbListingDB:
     """
@@ -21,55 +98,137 @@ class AirbnbListingDB:
 
     @staticmethod
     def get_by_id(id: int, db: Optional[AirbnbDatabase] = None) -> Optional['AirbnbListingDB']:
+        if not db and _listing_snapshot:
+            row = _listing_snapshot.get_row(id)
+            return AirbnbListingDB.from_db_dict(row) if row else None
+
+        # Only lookups on the default database are cached
+        cache = _listing_cache if not db else None
+        router = get_market_router() if not db else None
         if not db:
-            db = AirbnbDatabase()
+            db = get_default_database()
 
-        query = "SELECT * FROM listing WHERE id = :id"
-        row = db.fetch_data(query, {'id': id}, fetch_all=False)
+        if cache:
+            cache.validate(db)
+            listing = cache.listings.get(id)
+            if listing is not MISSING:
+                return listing
 
-        if not row:
-            return None
+        if router:
+            # The default database is the market index, the listing lives in its market's database
+            db = router.database_for(id)
+        query = f"SELECT {select_columns()} FROM listing WHERE id = :id"
+        row = db.fetch_data(query, {'id': id}, fetch_all=False) if db else None
+        listing = AirbnbListingDB.from_db_dict(row) if row else None
 
-        return AirbnbListingDB.from_db_dict(row)
+        if cache:
+            cache.listings.set(id, listing)
+        return listing
 
     @staticmethod
-    def get_by_ids(ids: List[int], db: Optional[AirbnbDatabase] = None) -> List['AirbnbListingDB']:
+    def get_by_ids(ids: List[int], fields: Optional[Sequence[str]] = None,
+                   db: Optional[AirbnbDatabase] = None) -> List['AirbnbListingDB']:
+        """
+        Returns the listings in the order of `ids`, skipping unknown ids. The ids are bound as
+        a single JSON array joined through json_each, so there is no variable limit to chunk
+        around, and only `fields` are selected when given.
+        """
+        if not db and _listing_snapshot:
+            select_columns(fields)
+            return [AirbnbListingDB.from_db_dict(row) for row in _listing_snapshot.get_rows(ids, fields)]
+
+        router = get_market_router() if not db else None
+        if router:
+            listings = {}
+            for market, market_ids in router.group_by_market(ids).items():
+                for listing in AirbnbListingDB.get_by_ids(market_ids, fields, router.markets[market]):
+                    listings[listing.id] = listing
+            return [listings[int(id)] for id in ids if int(id) in listings]
+
         if not db:
-            db = AirbnbDatabase()
+            db = get_default_database()
 
-        placeholders = ', '.join(':id' + str(i) for i in range(len(ids)))
-        query = f"SELECT * FROM listing WHERE id IN ({placeholders})"
-        params = {f'id{i}': id for i, id in enumerate(ids)}
-        rows = db.fetch_data(query, params, fetch_all=True)
+        query = f"""
+        SELECT {select_columns(fields)}
+        FROM json_each(:ids) AS requested
+        JOIN listing ON listing.id = requested.value
+        ORDER BY requested.key
+        """
+        rows = db.fetch_data(query, {'ids': json.dumps([int(id) for id in ids])}, fetch_all=True)
 
         return [AirbnbListingDB.from_db_dict(row) for row in rows]
 
     @staticmethod
     def get_all(skip: int = 0, limit: int = 10, db: Optional[AirbnbDatabase] = None) -> List['AirbnbListingDB']:
+        if not db and _listing_snapshot:
+            return [AirbnbListingDB.from_db_dict(row) for row in _listing_snapshot.get_all(skip, limit)]
+
+        router = get_market_router() if not db else None
+        if router:
+            return [
+                listing
+                for market_db, market_skip, market_limit in router.pages(skip, limit)
+                for listing in AirbnbListingDB.get_all(market_skip, market_limit, market_db)
+            ]
+
         if not db:
-            db = AirbnbDatabase()
+            db = get_default_database()
 
-        query = "SELECT * FROM listing LIMIT :limit OFFSET :skip"
+        query = f"SELECT {select_columns()} FROM listing LIMIT :limit OFFSET :skip"
         rows = db.fetch_data(query, {'limit': limit, 'skip': skip}, fetch_all=True)
 
         return [AirbnbListingDB.from_db_dict(row) for row in rows]
 
     @staticmethod
-    def get_listings_in_cluster(id: int, db: Optional[AirbnbDatabase] = None) -> Optional[List[int]]:
+    def get_listings_in_cluster(id: int, skip: int = 0, limit: int = 100,
+                                db: Optional[AirbnbDatabase] = None) -> Optional[List[int]]:
+        """
+        Returns a page of the listing's cluster, best ranked members first. A noise listing
+        is a cluster of its own
+        """
+        if not db and _listing_snapshot:
+            return _listing_snapshot.get_listings_in_cluster(id, skip, limit)
+
+        cache = _listing_cache if not db else None
+        router = get_market_router() if not db else None
         if not db:
-            db = AirbnbDatabase()
+            db = get_default_database()
+
+        if cache:
+            cache.validate(db)
+            members = cache.clusters.get((id, skip, limit))
+            if members is not MISSING:
+                return members
 
-        query = "SELECT listings_in_cluster FROM listing WHERE id = :id"
-        row = db.fetch_data(query, {'id': id}, fetch_all=False)
+        # Clusters are numbered per market, so they are read from the listing's market database
+        if router:
+            db = router.database_for(id)
+        members = AirbnbListingDB._fetch_listings_in_cluster(id, skip, limit, db) if db else None
+        if cache:
+            cache.clusters.set((id, skip, limit), members)
+        return members
 
-        if not row or 'listings_in_cluster' not in row:
+    @staticmethod
+    def _fetch_listings_in_cluster(id: int, skip: int, limit: int, db: AirbnbDatabase) -> Optional[List[int]]:
+        row = db.fetch_data("SELECT cluster FROM listing WHERE id = :id", {'id': id}, fetch_all=False)
+        if not row:
             return None
+        if row['cluster'] == -1:
+            return [id] if skip == 0 and limit > 0 else []
+
+        query = """
+        SELECT listing_id FROM cluster_member
+        WHERE cluster_id = :cluster
+        ORDER BY rank
+        LIMIT :limit OFFSET :skip
+        """
+        rows = db.fetch_data(query, {'cluster': row['cluster'], 'limit': limit, 'skip': skip}, fetch_all=True)
 
-        return [int(id_str) for id_str in row['listings_in_cluster'].split(',')]
+        return [row['listing_id'] for row in rows]
 
     def save(self, db: Optional[AirbnbDatabase] = None):
         if not db:
-            db = AirbnbDatabase()
+            db = get_default_database()
 
         columns = ', '.join(self.properties.keys())
         placeholders = ', '.join(f':{key}' for key in self.properties.keys())
@@ -93,7 +252,7 @@ if __name__ == '__main__':
     print(listing)
 
     # Get multiple listings by IDs
-    listings = AirbnbListingDB.get_by_ids([572612125615500056, 45267941], db)
+    listings = AirbnbListingDB.get_by_ids([572612125615500056, 45267941], db=db)
     for listing in listings:
         print(listing)
 
@@ -131,8 +290,7 @@ if __name__ == '__main__':
         description_summary="Cozy NYC apartment",
         property_outline="2-bedroom apartment",
         high_level_overview="Perfect for a NYC getaway",
-        cluster=205,
-        listings_in_cluster="100"
+        cluster=205
     )
     new_listing.save(db)
 
@@ -141,7 +299,7 @@ if __name__ == '__main__':
     print(saved_listing)
 
     # Get similar listings
-    similar_listings = AirbnbListingDB.get_listings_in_cluster(9999, db)
+    similar_listings = AirbnbListingDB.get_listings_in_cluster(9999, db=db)
     print(similar_listings)
 
     db.close_connection()
\ No newline at end of file
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import os
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+
+load_dotenv()
+
+EMBEDDINGS_ARTIFACT = 'embeddings'
+
+
+def default_artifacts_path():
+    """The configured artifacts directory, defaulting to a sibling of the DB file."""
+    path = os.getenv('ARTIFACTS_PATH')
+    if path:
+        return path
+    return os.path.splitext(os.getenv('DB_PATH'))[0] + '_artifacts'
+
+
+def artifact_path(name, path=None):
+    return os.path.join(path or default_artifacts_path(), f'{name}.parquet')
+
+
+def artifact_exists(name, path=None):
+    return os.path.exists(artifact_path(name, path))
+
+
+def _write_table(table, name, path=None, **kwargs):
+    # Written aside and renamed into place, so a failed stage never leaves a truncated artifact
+    target = artifact_path(name, path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    pq.write_table(table, target + '.tmp', **kwargs)
+    os.replace(target + '.tmp', target)
+
+
+def write_listings(name, df, path=None):
+    """Write a listings DataFrame as a typed Parquet artifact."""
+    _write_table(pa.Table.from_pandas(df, preserve_index=False), name, path)
+
+
+def read_listings(name, path=None):
+    if not artifact_exists(name, path):
+        raise FileNotFoundError(f"No '{name}' artifact in {path or default_artifacts_path()}, run that stage first")
+    return pq.read_table(artifact_path(name, path), memory_map=True).to_pandas()
+
+
+def _fixed_size_list(matrix):
+    matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+    return pa.FixedSizeListArray.from_arrays(pa.array(matrix.reshape(-1)), matrix.shape[1])
+
+
+def _matrix(column):
+    column = column.combine_chunks()
+    return column.values.to_numpy(zero_copy_only=False).reshape(len(column), column.type.list_size)
+
+
+def write_embeddings(ids, embeddings, average_embeddings, fields, path=None):
+    """Write the (n, len(fields), d) embeddings and (n, d) averages as fixed-size list columns.
+
+    The file is uncompressed and plain encoded: float vectors barely compress, and reading
+    them back is then a copy of the pages rather than a decode.
+    """
+    columns = {'id': pa.array(np.asarray(ids, dtype=np.int64))}
+    for i, field in enumerate(fields):
+        columns[field] = _fixed_size_list(embeddings[:, i, :])
+    columns['average'] = _fixed_size_list(average_embeddings)
+    _write_table(pa.table(columns), EMBEDDINGS_ARTIFACT, path, compression='NONE', use_dictionary=False)
+
+
+def read_embeddings(fields, path=None):
+    """Returns (ids, embeddings, average_embeddings) as written by `write_embeddings`."""
+    if not artifact_exists(EMBEDDINGS_ARTIFACT, path):
+        raise FileNotFoundError(f"No embeddings artifact in {path or default_artifacts_path()}, run that stage first")
+    table = pq.read_table(artifact_path(EMBEDDINGS_ARTIFACT, path), memory_map=True)
+    ids = table.column('id').to_numpy()
+    embeddings = np.stack([_matrix(table.column(field)) for field in fields], axis=1)
+    return ids, embeddings, _matrix(table.column('average'))
@@ -9,6 +9,53 @@ import numpy as np
 
 dirname = os.path.dirname(__file__)
 
+# Columns needed for the schema and model. Everything is read as text: ids and prices are
+# parsed by the cleaning steps, and the NUMERIC_COLUMNS are coerced chunk by chunk, so a stray
+# non-numeric cell becomes a missing value instead of failing the whole read
+LISTING_DTYPES = {
+    'id': 'object',
+    'listing_url': 'object',
+    'price': 'object',
+    'property_type': 'object',
+    'room_type': 'object',
+    'neighborhood_overview': 'object',
+    'bathrooms_text': 'object',
+    'bedrooms': 'object',
+    'beds': 'object',
+    'accommodates': 'object',
+    'latitude': 'object',
+    'longitude': 'object',
+    'neighbourhood_group_cleansed': 'object',
+    'neighbourhood_cleansed': 'object',
+    'description': 'object',
+    'amenities': 'object',
+    'host_about': 'object',
+    'review_scores_rating': 'object',
+    'review_scores_cleanliness': 'object',
+    'review_scores_checkin': 'object',
+    'review_scores_communication': 'object',
+    'review_scores_location': 'object',
+    'review_scores_value': 'object',
+    'number_of_reviews': 'object',
+}
+
+# Counts, scores and coordinates, as floats since they can be missing
+NUMERIC_COLUMNS = [
+    'bedrooms',
+    'beds',
+    'accommodates',
+    'latitude',
+    'longitude',
+    'review_scores_rating',
+    'review_scores_cleanliness',
+    'review_scores_checkin',
+    'review_scores_communication',
+    'review_scores_location',
+    'review_scores_value',
+    'number_of_reviews',
+]
+LISTING_COLUMNS = list(LISTING_DTYPES)
+
 
 @click.command()
 @click.argument("input_filepath", default=os.path.join(dirname, 'dataset/listings.csv'), type=click.Path(exists=True))
@@ -19,34 +66,88 @@ def main(input_filepath, output_filepath):
     """
     logger.info(f"Read from {input_filepath}, write to {output_filepath}.")
 
-    logger.info(f"Reading file...")
-    df = pd.read_csv(input_filepath)
+    logger.info(f"Computing statistics...")
+    stats = listing_statistics(read_listing_chunks(input_filepath))
 
     logger.info(f"Cleaning data...")
-    df_cleaned = clean_data(df)
-    
-    logger.info(f"Saving cleaned data...")
-    df_cleaned.to_csv(output_filepath, index=False)
+    header = True
+    for chunk in read_listing_chunks(input_filepath):
+        clean_data(chunk, stats).to_csv(output_filepath, index=False, header=header, mode='w' if header else 'a')
+        header = False
     logger.info(f"Cleaned data saved to {output_filepath}")
 
-def clean_data(df):
+def clean_data(df, stats=None):
+    """Clean a listings DataFrame.
+
+    Missing values are filled from `stats` (see `listing_statistics`) when given, so chunks of
+    one file are cleaned with the statistics of the whole file; otherwise from `df` itself.
+    """
     df = select_columns(df)
     df = remove_non_numeric_ids(df)
-    df = handle_missing_values(df)
+    stats = stats or column_statistics(df)
+    df = handle_missing_values(df, stats)
     df = clean_price_column(df)
-    df = handle_missing_price(df)
+    df = handle_missing_price(df, stats)
     df = convert_data_match_schema(df)
     return df
 
+def read_listing_chunks(input_filepath, chunksize=None):
+    """Stream the needed columns of a raw listings CSV in chunks of `chunksize` rows, with the
+    NUMERIC_COLUMNS parsed as floats and unparseable cells as NaN."""
+    chunksize = chunksize or int(os.getenv('CSV_CHUNK_SIZE', 50000))
+    for chunk in pd.read_csv(input_filepath, usecols=LISTING_COLUMNS, dtype=LISTING_DTYPES, chunksize=chunksize):
+        chunk[NUMERIC_COLUMNS] = chunk[NUMERIC_COLUMNS].apply(pd.to_numeric, errors='coerce').astype('float64')
+        yield chunk
+
+def column_statistics(df):
+    """Row count, non-null counts, numeric sums and the parsed price sum of rows with a valid id."""
+    numeric_cols = df.select_dtypes(include=['float64', 'int64']).columns
+    prices = parse_price(df['price']) if 'price' in df.columns else pd.Series(dtype=float)
+    return {
+        'rows': len(df),
+        'non_null': df.notna().sum().to_dict(),
+        'sums': df[numeric_cols].sum().to_dict(),
+        'price_sum': float(prices.sum()),
+        'price_count': int(prices.count()),
+    }
+
+def merge_statistics(total, stats):
+    if total is None:
+        return stats
+    return {
+        'rows': total['rows'] + stats['rows'],
+        'non_null': {col: total['non_null'].get(col, 0) + count for col, count in stats['non_null'].items()},
+        'sums': {col: total['sums'].get(col, 0.0) + value for col, value in stats['sums'].items()},
+        'price_sum': total['price_sum'] + stats['price_sum'],
+        'price_count': total['price_count'] + stats['price_count'],
+    }
+
+def listing_statistics(chunks):
+    """First streaming pass: the statistics `clean_data` needs, over every chunk of a file."""
+    total = None
+    for chunk in chunks:
+        total = merge_statistics(total, column_statistics(remove_non_numeric_ids(select_columns(chunk))))
+    return total
+
+def content_hashes(df):
+    """Hash of every listing's source columns, indexed by id.
+
+    Computed on the raw rows, before missing values are filled with dataset-wide means, so a
+    listing's hash only changes when the listing itself changes.
+    """
+    df = remove_non_numeric_ids(select_columns(df))
+    hashes = pd.util.hash_pandas_object(df.astype(str), index=False)
+    hashes = pd.Series([f'{h:016x}' for h in hashes.to_numpy()], index=df['id'].to_numpy())
+    return hashes[~hashes.index.duplicated(keep='last')]
+
 def select_columns(df):
     # select columns that are needed for the schema and model
-    listing_df_cols = ['id', 'listing_url', 'price', 'property_type', 'room_type', 'neighborhood_overview', 'bathrooms_text', 'bedrooms', 'beds', 'accommodates', 'latitude', 'longitude', 'neighbourhood_group_cleansed', 'neighbourhood_cleansed', 'neighborhood_overview', 'description', 'amenities', 'host_about', 'review_scores_rating', 'review_scores_cleanliness', 'review_scores_checkin', 'review_scores_communication', 'review_scores_location', 'review_scores_value', 'number_of_reviews']
-    return df[listing_df_cols]
+    return df[LISTING_COLUMNS]
 
-def handle_missing_values(df):
+def handle_missing_values(df, stats):
     # Drop columns with too many missing values (more than 50%)
-    threshold = 0.5 * len(df)
-    df_cleaned = df.dropna(thresh=threshold, axis=1)
+    threshold = 0.5 * stats['rows']
+    df_cleaned = df[[col for col in df.columns if stats['non_null'].get(col, 0) >= threshold]].copy()
 
     # Fill missing string/object columns with empty strings
     string_cols = df_cleaned.select_dtypes(include=['object']).columns
@@ -59,34 +160,32 @@ def handle_missing_values(df):
         if col == 'bedrooms' or col == 'beds':
             df_cleaned[col] = df_cleaned[col].fillna(0)
         else:
-            df_cleaned[col] = df_cleaned[col].fillna(df_cleaned[col].mean())
-
-    # Fill missing numerical columns with mean (for simplicity)
-    numeric_cols = df_cleaned.select_dtypes(include=['float64', 'int64']).columns
-    for col in numeric_cols:
-        df_cleaned[col] = df_cleaned[col].fillna(df_cleaned[col].mean())
+            non_null = stats['non_null'].get(col, 0)
+            mean = stats['sums'][col] / non_null if non_null else np.nan
+            df_cleaned[col] = df_cleaned[col].fillna(mean)
 
     return df_cleaned
 
+def parse_price(prices):
+    # remove $ and , and parse, malformed prices become NaN
+    prices = prices.replace('', np.nan).replace({'\\$': '', ',': ''}, regex=True)
+    return pd.to_numeric(prices, errors='coerce').astype(float)
+
 def clean_price_column(df):
-    # remove $ and , from price column
     if 'price' in df.columns:
-        df.loc[:, 'price'] = df['price'].replace('', np.nan)
-        df.loc[:, 'price'] = df['price'].replace({'\$': '', ',': ''}, regex=True)
-        df.loc[:, 'price'] = pd.to_numeric(df['price'], errors='coerce')
-        df.loc[:, 'price'] = df['price'].astype(float)
+        df['price'] = parse_price(df['price'])
     return df
 
 def remove_non_numeric_ids(df):
-    # Remove rows where 'id' is not numeric
-    df['id'] = pd.to_numeric(df['id'], errors='coerce')
-    df = df.dropna(subset=['id'])
-    df['id'] = df['id'].astype(int)
+    # Remove rows where 'id' is not numeric. Valid ids are parsed again on their own so
+    # 18 digit ids don't lose precision through a float column
+    df = df[pd.to_numeric(df['id'], errors='coerce').notna()].copy()
+    df['id'] = pd.to_numeric(df['id']).astype('int64')
     return df
 
-def handle_missing_price(df):
+def handle_missing_price(df, stats):
     # fill missing price with average price
-    average_price = df['price'].mean()
+    average_price = stats['price_sum'] / stats['price_count'] if stats['price_count'] else np.nan
     df['price'] = df['price'].fillna(average_price)
     return df
 
@@ -10,6 +10,8 @@ from loguru import logger
 import torch
 from dotenv import load_dotenv
 
+from ml.features.embedding_cache import open_embedding_cache, text_hash
+
 load_dotenv()
 
 def create_overview(row):
@@ -116,20 +118,138 @@ def construct_high_level_overview(row):
     
     return property_desc
 
-def generate_embeddings_with_progress(df, column_name, model, batch_size=32):
-    embeddings = []
-    tqdm.pandas(desc=f"Generating embeddings for {column_name}")
+# Column-wise versions of the row builders above, producing the same text for every row.
+# The row builders stay as the reference that scripts/bench_text_features.py checks against.
 
-    for i in tqdm(range(0, len(df), batch_size), desc="Batch Encoding"):
-        batch = df[column_name].iloc[i:i + batch_size].tolist()
-        batch_embeddings = model.encode(batch, convert_to_tensor=True)
-        embeddings.extend(batch_embeddings.tolist())
+# (column, >= 4.5, >= 3.5, otherwise) for every review score evaluated by `evaluate_listing`
+REVIEW_SCORE_SENTENCES = [
+    ('review_scores_cleanliness',
+     "• The property is consistently rated highly for cleanliness.",
+     "• The property is generally clean but could use some improvement.",
+     "• Cleanliness is often highlighted as a concern by guests."),
+    ('review_scores_checkin',
+     "• The check-in process is rated as smooth and easy by most guests.",
+     "• The check-in process is generally okay, but there might be occasional issues.",
+     "• Guests frequently report issues with the check-in process."),
+    ('review_scores_communication',
+     "• The host is highly responsive and easy to communicate with.",
+     "• Communication with the host is generally fine, with some areas for improvement.",
+     "• Guests have often faced difficulties in communicating with the host."),
+    ('review_scores_location',
+     "• The location is highly rated by guests, with many finding it convenient.",
+     "• The location is generally good but may not be ideal for everyone.",
+     "• The location might not be convenient or desirable for many guests."),
+    ('review_scores_value',
+     "• Guests believe the property offers excellent value for money.",
+     "• The property offers reasonable value, though some guests may feel it's a bit pricey.",
+     "• Guests feel the property does not offer good value for the price."),
+]
 
-    # Normalize the embeddings
-    normalized_embeddings = normalize(np.array(embeddings), norm='l2', axis=1)
-    
-    df[f'{column_name}_embedding'] = normalized_embeddings.tolist()
-    return df
+def _text(values):
+    # str(value) for every value, as the f-strings of the row builders format them
+    return values.map(str).astype(object)
+
+def _int_or_na(values):
+    # int(value), or 'N/A' for missing values
+    text = pd.Series('N/A', index=values.index, dtype=object)
+    present = values.notna()
+    text[present] = _text(values[present].astype('int64'))
+    return text
+
+def _formatted_or_empty(values, template):
+    # template.format(value), or '' for missing values
+    text = pd.Series('', index=values.index, dtype=object)
+    present = values.notna()
+    text[present] = values[present].map(template.format)
+    return text
+
+def _is_str(values):
+    return values.map(lambda value: isinstance(value, str)).astype(bool)
+
+def create_overviews(df):
+    """Column-wise `create_overview` for every row of `df`."""
+    text = (
+        "This " + _int_or_na(df['bedrooms']) + "-bedroom " + _text(df['property_type'])
+        + " is located in " + _text(df['neighbourhood_cleansed']) + ". "
+        + "The " + _text(df['room_type']) + " accommodates " + _int_or_na(df['accommodates'])
+        + " guests with " + _int_or_na(df['beds']) + " bed(s) and " + _text(df['bathrooms_text']) + ". "
+        + _formatted_or_empty(df['price'], "The price per night is ${:.2f}. ")
+        + _formatted_or_empty(df['review_scores_rating'], "The property has a review rating of {:.1f}/5")
+    )
+    return text.str.strip()
+
+def evaluate_listings(df):
+    """Column-wise `evaluate_listing` for every row of `df`."""
+    description = df['description'].where(df['description'].notna(), "No detailed description available.")
+    outline = "Property Description: " + _text(description) + " Review Overview:"
+
+    all_high = df['review_scores_rating'].to_numpy() >= 4.5
+    for column, high, medium, low in REVIEW_SCORE_SENTENCES:
+        scores = df[column].to_numpy()
+        all_high &= scores >= 4.5
+        outline = outline + np.select([scores >= 4.5, scores >= 3.5], [high, medium], default=low).astype(object)
+
+    return outline + np.where(
+        all_high,
+        "Overall, the reviews suggest that the property consistently meets or exceeds expectations.",
+        "There are some areas where guest experiences may not fully align with the description, particularly in the aspects highlighted above.",
+    ).astype(object)
+
+def construct_high_level_overviews(df):
+    """Column-wise `construct_high_level_overview` for every row of `df`."""
+    text = "This is a " + _text(df['property_type']) + "."
+    description = df['description']
+    text = text + (" " + _text(description)).where(_is_str(description), '')
+    overview = df['neighborhood_overview']
+    text = text + (" The neighborhood is described as: " + _text(overview)).where(_is_str(overview), '')
+    return text
+
+# Text fields encoded for every listing, in the order of the embedding array's second axis
+EMBEDDING_FIELDS = ['property_outline', 'description_summary', 'high_level_overview']
+DEFAULT_EMBEDDING_WEIGHTS = [0.5, 0.3, 0.2]
+
+def generate_embeddings(df, model, fields=EMBEDDING_FIELDS, batch_size=None, cache=None):
+    """Encode every text field of every listing in one pass.
+
+    Identical texts are encoded once and texts already in `cache` (an EmbeddingCache) are not
+    encoded at all. The remaining texts are sorted by length so each batch pads to a similar
+    length, and the normalized embeddings are returned as a float32 array of shape
+    (n, len(fields), d).
+    """
+    batch_size = batch_size or int(os.getenv('EMBEDDING_BATCH_SIZE', 64))
+    n = len(df)
+    texts = [text for field in fields for text in df[field].astype(str).tolist()]
+
+    positions = {}
+    inverse = np.array([positions.setdefault(text, len(positions)) for text in texts], dtype=np.int64)
+    unique_texts = list(positions)
+    del positions
+
+    vectors = np.empty((len(unique_texts), model.get_sentence_embedding_dimension()), dtype=np.float32)
+    hashes = [text_hash(text) for text in unique_texts]
+    cached = cache.get_many(hashes) if cache else {}
+    for i, key in enumerate(hashes):
+        if key in cached:
+            vectors[i] = cached[key]
+    pending = [i for i, key in enumerate(hashes) if key not in cached]
+    logger.info(f"{len(texts)} texts, {len(unique_texts)} distinct, {len(pending)} to encode.")
+
+    # Longest first, so a batch that doesn't fit in memory fails right away
+    pending.sort(key=lambda i: -len(unique_texts[i]))
+    for start in tqdm(range(0, len(pending), batch_size), desc="Batch Encoding"):
+        batch = pending[start:start + batch_size]
+        vectors[batch] = model.encode(
+            [unique_texts[i] for i in batch],
+            batch_size=batch_size,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+            show_progress_bar=False,
+        )
+        if cache:
+            cache.put_many([hashes[i] for i in batch], vectors[batch])
+
+    # Texts are laid out field by field, the embedding array is listing by listing
+    return np.ascontiguousarray(vectors[inverse].reshape(len(fields), n, -1).transpose(1, 0, 2))
 
 def weighted_average_embedding(embeddings, weights):
     embeddings = [np.array(embedding) for embedding in embeddings]
@@ -141,40 +261,75 @@ def weighted_average_embedding(embeddings, weights):
     
     return normalized_avg_embedding
 
-def apply_weighted_average(df, weight_outline=0.5, weight_description=0.3, weight_overview=0.2):
-    weights = [weight_outline, weight_description, weight_overview]
+def embedding_weights():
+    """Per-field weights in EMBEDDING_FIELDS order, from EMBEDDING_WEIGHTS (e.g. `0.5,0.3,0.2`)."""
+    raw = os.getenv('EMBEDDING_WEIGHTS')
+    if not raw:
+        return DEFAULT_EMBEDDING_WEIGHTS
+    weights = [float(weight) for weight in raw.split(',')]
+    if len(weights) != len(EMBEDDING_FIELDS) or sum(weights) <= 0:
+        raise ValueError(f"EMBEDDING_WEIGHTS needs {len(EMBEDDING_FIELDS)} weights with a positive sum, got {raw!r}")
+    return weights
 
-    tqdm.pandas(desc="Calculating weighted average embeddings")
-    
-    df['average_embedding'] = df.progress_apply(
-        lambda row: weighted_average_embedding(
-            [row['property_outline_embedding'], row['description_summary_embedding'], row['high_level_overview_embedding']],
-            weights
-        ), axis=1
-    )
-    
+def apply_weighted_average(embeddings, weights=None):
+    """Combine (n, fields, d) embeddings into L2 normalized (n, d) weighted averages in one pass."""
+    weights = np.asarray(weights if weights is not None else embedding_weights(), dtype=np.float32)
+    averaged = np.einsum('nfd,f->nd', embeddings, weights / weights.sum(), optimize=True)
+
+    # Normalize the weighted average embeddings row-wise, in place
+    averaged /= np.maximum(np.linalg.norm(averaged, axis=1, keepdims=True), 1e-12)
+    return averaged
+
+def add_text_features(df):
+    """Add the text features the embeddings are computed from."""
+    df['description_summary'] = create_overviews(df)
+    df['property_outline'] = evaluate_listings(df)
+    df['high_level_overview'] = construct_high_level_overviews(df)
     return df
 
-def pipeline(df):
-    logger.info("Start building features.")
-    
-    # Create overviews and outlines
-    df['description_summary'] = df.apply(create_overview, axis=1)
-    df['property_outline'] = df.apply(evaluate_listing, axis=1)
-    df['high_level_overview'] = df.apply(construct_high_level_overview, axis=1)
-    
-    # Load the Sentence Transformer model
-    model = SentenceTransformer(os.getenv('SENTENCE_TRANSFORMER_MODEL'))
-    device = torch.device('mps' if torch.backends.mps.is_available() else 'cpu')
-    model.to(device)
+_models = {}
+
+def load_model(model_name):
+    """The Sentence Transformer model, loaded once per process and reused by every build in it."""
+    if model_name not in _models:
+        model = SentenceTransformer(model_name)
+        device = torch.device('mps' if torch.backends.mps.is_available() else 'cpu')
+        model.to(device)
+        _models[model_name] = model
+    return _models[model_name]
+
+def embed_listings(df, compact_cache=True):
+    """Embed the text features of every listing.
+
+    Returns the per-field embeddings as a float32 (n, 3, d) array in EMBEDDING_FIELDS order and
+    the (n, d) weighted average embeddings, both aligned with the DataFrame rows. Incremental
+    refreshes only pass the changed listings and set `compact_cache` to False, so the cached
+    embeddings of unchanged listings aren't evicted as unused.
+    """
+    model_name = os.getenv('SENTENCE_TRANSFORMER_MODEL')
+    model = load_model(model_name)
     
-    # Generate embeddings
-    df = generate_embeddings_with_progress(df, 'property_outline', model)
-    df = generate_embeddings_with_progress(df, 'description_summary', model)
-    df = generate_embeddings_with_progress(df, 'high_level_overview', model)
+    # Generate embeddings, reusing the ones cached by previous builds
+    cache = open_embedding_cache(model_name)
+    try:
+        embeddings = generate_embeddings(df, model, cache=cache)
+        if cache and compact_cache:
+            cache.compact()
+    finally:
+        if cache:
+            cache.close()
     
     # Calculate weighted average embeddings
-    df = apply_weighted_average(df)
-    
+    average_embeddings = apply_weighted_average(embeddings)
+    return embeddings, average_embeddings
+
+def pipeline(df, compact_cache=True):
+    """Build the text features and embeddings of every listing.
+
+    Returns the DataFrame with the text features added and the outputs of `embed_listings`.
+    """
+    logger.info("Start building features.")
+    df = add_text_features(df)
+    embeddings, average_embeddings = embed_listings(df, compact_cache=compact_cache)
     logger.info("Finished building features.")
-    return df
+    return df, embeddings, average_embeddings
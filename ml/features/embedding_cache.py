@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import hashlib
+import time
+
+import numpy as np
+from loguru import logger
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CREATE_EMBEDDING_TABLE_QUERY = '''
+CREATE TABLE IF NOT EXISTS embedding (
+    model TEXT NOT NULL,
+    text_hash BLOB NOT NULL,
+    vector BLOB NOT NULL,
+    last_used_run INTEGER NOT NULL,
+    PRIMARY KEY (model, text_hash)
+) WITHOUT ROWID
+'''
+
+CREATE_META_TABLE_QUERY = '''
+CREATE TABLE IF NOT EXISTS cache_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+)
+'''
+
+# Keeps the number of bound parameters under SQLite's limit
+CHUNK_SIZE = 500
+
+
+def default_embedding_cache_path():
+    """The configured cache file, defaulting to a sibling of the DB file."""
+    path = os.getenv('EMBEDDING_CACHE_PATH')
+    if path:
+        return path
+    return os.path.splitext(os.getenv('DB_PATH'))[0] + '_embeddings.db'
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode('utf-8')).digest()
+
+
+class EmbeddingCache:
+    """On-disk cache of text embeddings keyed by (model name, SHA-1 of the text).
+
+    Every build is a numbered run: entries read or written during a run are stamped with it,
+    and `compact` drops entries unused for `keep_runs` runs, so listings that left the dataset
+    don't grow the file forever. Entries of other models are kept until they age out the same
+    way, so switching back to a recent model still finds them.
+    """
+    def __init__(self, path, model, keep_runs=3):
+        self.path = path
+        self.model = model
+        self.keep_runs = keep_runs
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute(CREATE_EMBEDDING_TABLE_QUERY)
+            self.connection.execute(CREATE_META_TABLE_QUERY)
+            row = self.connection.execute("SELECT value FROM cache_meta WHERE key = 'run'").fetchone()
+            self.run = int(row[0]) + 1 if row else 1
+            self.connection.execute(
+                "INSERT OR REPLACE INTO cache_meta (key, value) VALUES ('run', ?)", (str(self.run),)
+            )
+
+    def get_many(self, hashes):
+        """Returns {hash: float32 vector} for the cached hashes, stamping them with the current run."""
+        found = {}
+        with self.connection:
+            for start in range(0, len(hashes), CHUNK_SIZE):
+                chunk = hashes[start:start + CHUNK_SIZE]
+                placeholders = ','.join('?' * len(chunk))
+                rows = self.connection.execute(
+                    f"SELECT text_hash, vector FROM embedding WHERE model = ? AND text_hash IN ({placeholders})",
+                    (self.model, *chunk),
+                ).fetchall()
+                self.connection.execute(
+                    f"UPDATE embedding SET last_used_run = ? WHERE model = ? AND text_hash IN ({placeholders})",
+                    (self.run, self.model, *chunk),
+                )
+                for key, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=np.float32)
+        self.hits += len(found)
+        self.misses += len(hashes) - len(found)
+        return found
+
+    def put_many(self, hashes, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embedding (model, text_hash, vector, last_used_run) VALUES (?, ?, ?, ?)",
+                ((self.model, key, vector.tobytes(), self.run) for key, vector in zip(hashes, vectors)),
+            )
+
+    def compact(self):
+        """Evicts stale entries and reclaims the space when a sizeable share was dropped."""
+        with self.connection:
+            total = self.connection.execute("SELECT COUNT(*) FROM embedding").fetchone()[0]
+            deleted = self.connection.execute(
+                "DELETE FROM embedding WHERE last_used_run <= ?", (self.run - self.keep_runs,),
+            ).rowcount
+        if deleted:
+            logger.info(f"Evicted {deleted} of {total} cached embeddings.")
+        if total and deleted / total > 0.25:
+            start = time.time()
+            self.connection.execute('VACUUM')
+            logger.info(f"Compacted the embedding cache in {time.time() - start:.1f}s.")
+
+    def close(self):
+        self.connection.close()
+
+
+def open_embedding_cache(model):
+    """The embedding cache for `model`, or None when EMBEDDING_CACHE_ENABLED is False."""
+    if os.getenv('EMBEDDING_CACHE_ENABLED', 'True') != 'True':
+        return None
+    return EmbeddingCache(
+        default_embedding_cache_path(), model, keep_runs=int(os.getenv('EMBEDDING_CACHE_KEEP_RUNS', 3))
+    )
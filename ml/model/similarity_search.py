@@ -2,67 +2,302 @@
 from pathlib import Path
 import pandas as pd
 import numpy as np
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
 import hdbscan
+from scipy import sparse
 from sklearn.cluster import DBSCAN
 from tqdm import tqdm
 from loguru import logger
 from dotenv import load_dotenv
+import joblib
 import os
 
 load_dotenv()
 
-def apply_pca(valid_vectors_df):
-    """Apply PCA to reduce the dimensionality of the vector data."""
-    pca = PCA(n_components='mle', svd_solver='full')
-    reduced_data = pca.fit_transform(np.stack(valid_vectors_df['average_embedding'].values))
-    return reduced_data
+class Reducer:
+    """Fitted projection onto the top principal components, `(x - mean) @ components.T`.
 
-def perform_clustering_hdbscan(reduced_data, similarity_threshold, min_cluster_size, min_samples):
-    """Perform clustering on the dimensionality reduced data using HDBSCAN."""
+    Persisted with the HDBSCAN clusterer so listings embedded later are projected into the
+    same space without refitting.
+    """
+    def __init__(self, mean, components, explained_variance_ratio):
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)
+        self.explained_variance_ratio = np.asarray(explained_variance_ratio)
+
+    @property
+    def n_components(self):
+        return len(self.components)
+
+    def transform(self, vectors):
+        return (np.asarray(vectors, dtype=np.float32) - self.mean) @ self.components.T
+
+def fit_reducer(vectors, n_components=None, solver=None, max_components=None):
+    """Fit the PCA applied before HDBSCAN.
+
+    `n_components` is a component count, or a share of the variance to keep when below 1
+    (PCA_COMPONENTS, default 0.95). For a variance target at most `max_components` are fitted
+    (PCA_MAX_COMPONENTS) and the smallest prefix reaching the target is kept. `solver` is
+    'randomized' (default), 'incremental' for bounded memory on large n, or 'full'.
+    """
+    n_components = n_components or float(os.getenv('PCA_COMPONENTS', 0.95))
+    solver = solver or os.getenv('PCA_SOLVER', 'randomized')
+    max_components = max_components or int(os.getenv('PCA_MAX_COMPONENTS', 256))
+    vectors = np.asarray(vectors, dtype=np.float32)
+    limit = min(vectors.shape)
+    fitted = min(int(n_components), limit) if n_components >= 1 else min(max_components, limit)
+
+    if solver == 'incremental':
+        pca = IncrementalPCA(n_components=fitted, batch_size=max(fitted, int(os.getenv('PCA_BATCH_SIZE', 8192))))
+    elif solver in ('randomized', 'full'):
+        pca = PCA(n_components=fitted, svd_solver=solver, random_state=0)
+    else:
+        raise ValueError(f"Unsupported PCA_SOLVER: {solver}")
+    pca.fit(vectors)
+
+    kept = fitted
+    if n_components < 1:
+        kept = int(np.searchsorted(np.cumsum(pca.explained_variance_ratio_), n_components) + 1)
+        kept = min(kept, fitted)
+    logger.info(f"Keeping {kept} components, {pca.explained_variance_ratio_[:kept].sum():.3f} of the variance.")
+    return Reducer(pca.mean_, pca.components_[:kept], pca.explained_variance_ratio_[:kept])
+
+def perform_clustering_hdbscan(reduced_data, similarity_threshold, min_cluster_size, min_samples, n_jobs=None):
+    """Perform clustering on the dimensionality reduced data using HDBSCAN.
+
+    The clusterer keeps its prediction data, so new points can be labelled with
+    `hdbscan.approximate_predict` without a refit.
+    """
     clusterer = hdbscan.HDBSCAN(
         min_cluster_size=min_cluster_size,
-        min_samples=min_cluster_size,
+        min_samples=min_samples,
         metric='euclidean',
-        cluster_selection_epsilon= 1 - similarity_threshold
+        cluster_selection_epsilon= 1 - similarity_threshold,
+        core_dist_n_jobs=n_jobs or int(os.getenv('CLUSTERING_N_JOBS', -1)),
+        prediction_data=True,
     )
     labels = clusterer.fit_predict(reduced_data)
     return labels, clusterer
 
-def perform_clustering_dbscan(valid_vectors_df, similarity_threshold, min_samples):
-    """Perform DBSCAN clustering on preprocessed data."""
-    eps_value = 1 - similarity_threshold
-    db = DBSCAN(eps=eps_value, min_samples=min_samples, metric='cosine')
-    valid_vectors_df['cluster'] = db.fit_predict(np.stack(valid_vectors_df['average_embedding'].values))
-    return valid_vectors_df
+def default_clustering_model_path():
+    """The configured reducer/clusterer file, defaulting to a sibling of the DB file."""
+    path = os.getenv('CLUSTERING_MODEL_PATH')
+    if path:
+        return path
+    return os.path.splitext(os.getenv('DB_PATH'))[0] + '_clustering.joblib'
+
+def save_clustering_model(reducer, clusterer, path=None):
+    path = path or default_clustering_model_path()
+    joblib.dump({'reducer': reducer, 'clusterer': clusterer}, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+def load_clustering_model(path=None):
+    """The persisted {'reducer', 'clusterer'}, or None when no HDBSCAN clustering was saved."""
+    path = path or default_clustering_model_path()
+    if not os.path.exists(path):
+        return None
+    return joblib.load(path)
+
+def predict_clusters(model, vectors):
+    """Cluster labels (-1 for noise) of new embeddings from a persisted reducer and clusterer."""
+    if len(vectors) == 0:
+        return np.empty(0, dtype=int)
+    labels, _ = hdbscan.approximate_predict(model['clusterer'], model['reducer'].transform(vectors))
+    return labels
+
+def _normalize(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1), 1e-12)[:, None]
+
+def _nearest_centroids(vectors, centroids, k, working_memory_mb):
+    """The k most similar centroids of every row, most similar first."""
+    block_size = max(1, working_memory_mb * 1024 * 1024 // (4 * len(centroids)))
+    nearest = np.empty((len(vectors), k), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        scores = vectors[start:start + block_size] @ centroids.T
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k] if k < len(centroids) else np.tile(np.arange(k), (len(scores), 1))
+        order = np.argsort(-np.take_along_axis(scores, top, axis=1), axis=1)
+        nearest[start:start + block_size] = np.take_along_axis(top, order, axis=1)
+    return nearest
+
+def _spherical_kmeans(vectors, n_lists, working_memory_mb, n_iter=10, sample_size=65536, seed=0):
+    """Unit norm centroids trained with Lloyd iterations on a sample of the rows."""
+    rng = np.random.default_rng(seed)
+    sample = vectors[np.sort(rng.choice(len(vectors), min(len(vectors), max(sample_size, n_lists)), replace=False))]
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)]
+    for _ in range(n_iter):
+        assign = _nearest_centroids(sample, centroids, 1, working_memory_mb)[:, 0]
+        membership = sparse.csr_matrix(
+            (np.ones(len(sample), dtype=np.float32), (assign, np.arange(len(sample)))), shape=(n_lists, len(sample))
+        )
+        sums = np.asarray(membership @ sample)
+        empty = np.flatnonzero(np.bincount(assign, minlength=n_lists) == 0)
+        sums[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+        centroids = _normalize(sums).astype(np.float32)
+    return centroids
+
+def _exact_radius_pairs(vectors, similarity_threshold, working_memory_mb):
+    """Every pair (i < j) at or above the threshold, from blocked all-pairs dot products."""
+    n = len(vectors)
+    block_size = max(1, min(n, working_memory_mb * 1024 * 1024 // (4 * max(n, 1))))
+    rows, cols, similarities = [], [], []
+    for start in tqdm(range(0, n, block_size), desc="Radius neighbours"):
+        scores = vectors[start:start + block_size] @ vectors[start:].T
+        block_rows, block_cols = np.nonzero(scores >= similarity_threshold)
+        upper = block_cols + start > block_rows + start
+        block_rows, block_cols = block_rows[upper], block_cols[upper]
+        rows.append(block_rows + start)
+        cols.append(block_cols + start)
+        similarities.append(scores[block_rows, block_cols])
+    return np.concatenate(rows), np.concatenate(cols), np.concatenate(similarities)
+
+def _ivf_radius_pairs(vectors, similarity_threshold, n_lists, nprobe, working_memory_mb):
+    """Pairs (i < j) at or above the threshold among IVF candidates: the rows are bucketed
+    by their nearest of `n_lists` k-means centroids, every row is scored exactly against the
+    rows of its `nprobe` nearest buckets, and a pair is kept when either row probes the
+    other's bucket."""
+    n = len(vectors)
+    centroids = _spherical_kmeans(vectors, n_lists, working_memory_mb)
+    probes = _nearest_centroids(vectors, centroids, nprobe, working_memory_mb)
+    bucket_rows = np.argsort(probes[:, 0], kind='stable')
+    bucket_offsets = np.concatenate([[0], np.cumsum(np.bincount(probes[:, 0], minlength=n_lists))])
+    # The rows probing every bucket
+    query_rows = np.argsort(probes.ravel(), kind='stable') // nprobe
+    query_offsets = np.concatenate([[0], np.cumsum(np.bincount(probes.ravel(), minlength=n_lists))])
+    del probes
+
+    rows, cols, similarities = [], [], []
+    for bucket in tqdm(range(n_lists), desc="Radius neighbours"):
+        members = bucket_rows[bucket_offsets[bucket]:bucket_offsets[bucket + 1]]
+        queries = query_rows[query_offsets[bucket]:query_offsets[bucket + 1]]
+        if len(members) == 0 or len(queries) == 0:
+            continue
+        member_vectors = vectors[members]
+        block_size = max(1, working_memory_mb * 1024 * 1024 // (4 * len(members)))
+        for start in range(0, len(queries), block_size):
+            block = queries[start:start + block_size]
+            scores = vectors[block] @ member_vectors.T
+            block_rows, block_cols = np.nonzero(scores >= similarity_threshold)
+            i, j = block[block_rows], members[block_cols]
+            other = i != j
+            rows.append(np.minimum(i, j)[other])
+            cols.append(np.maximum(i, j)[other])
+            similarities.append(scores[block_rows, block_cols][other])
+
+    rows, cols, similarities = np.concatenate(rows), np.concatenate(cols), np.concatenate(similarities)
+    # A pair is found twice when both rows probe the other's bucket
+    _, first = np.unique(rows * n + cols, return_index=True)
+    return rows[first], cols[first], similarities[first]
 
-def pipeline_clustering(df):
+def radius_neighbors_graph(vectors, similarity_threshold, working_memory_mb=None, nprobe=None, n_lists=None):
+    """Sparse (n, n) cosine distance graph holding the pairs of rows whose cosine similarity
+    reaches the threshold.
+
+    Rows are L2 normalized, so cosine similarity is a dot product. By default the candidate
+    pairs come from an IVF partition of the rows (`n_lists` buckets, 4 * sqrt(n) by default,
+    `nprobe` probed per row) and are rescored exactly, so the cost grows with
+    n * nprobe * n / n_lists rather than n². With `nprobe` 0 (or at least `n_lists`) every
+    pair is scored, in blocks of rows multiplied with the rows from the block on. Either way
+    a block of scores stays within `working_memory_mb`.
+    """
+    working_memory_mb = working_memory_mb or int(os.getenv('CLUSTERING_WORKING_MEMORY_MB', 512))
+    nprobe = int(os.getenv('CLUSTERING_NPROBE', 16)) if nprobe is None else nprobe
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1)
+    if not np.allclose(norms, 1.0, atol=1e-3):
+        vectors = _normalize(vectors)
+
+    n = len(vectors)
+    n_lists = min(n, n_lists or int(os.getenv('CLUSTERING_N_LISTS') or 0) or max(1, int(4 * np.sqrt(n))))
+    if nprobe <= 0 or nprobe >= n_lists:
+        rows, cols, similarities = _exact_radius_pairs(vectors, similarity_threshold, working_memory_mb)
+    else:
+        rows, cols, similarities = _ivf_radius_pairs(vectors, similarity_threshold, n_lists, nprobe, working_memory_mb)
+
+    distances = np.maximum(1.0 - similarities, 0.0)
+    logger.info(f"{len(rows)} neighbour pairs at similarity >= {similarity_threshold}.")
+    return sparse.csr_matrix(
+        (np.concatenate([distances, distances]), (np.concatenate([rows, cols]), np.concatenate([cols, rows]))),
+        shape=(n, n),
+    )
+
+def perform_clustering_dbscan(vectors, similarity_threshold, min_samples, n_jobs=None):
+    """Perform DBSCAN clustering on the precomputed radius neighbours graph of the vectors.
+
+    Same clusters as DBSCAN with metric='cosine' and eps = 1 - similarity_threshold (the
+    euclidean radius between unit vectors is sqrt(2 * (1 - similarity_threshold))) when
+    every pair is scored (CLUSTERING_NPROBE=0), up to the pairs the IVF probes miss otherwise,
+    without the brute-force pairwise distance matrix.
+    """
+    n_jobs = n_jobs or int(os.getenv('CLUSTERING_N_JOBS', -1))
+    graph = radius_neighbors_graph(vectors, similarity_threshold)
+    db = DBSCAN(eps=1 - similarity_threshold, min_samples=min_samples, metric='precomputed', n_jobs=n_jobs)
+    return db.fit_predict(graph)
+
+def pipeline_clustering(df, vectors):
+    """Add a `cluster` column to `df`, clustering the (n, d) embeddings aligned with its rows."""
     logger.info("Start clustering process.")
     
-    # Filter out rows with null embeddings
-    valid_vectors_df = df[df['average_embedding'].notnull()]
-    
     # Apply PCA if enabled
     if os.getenv('USE_PCA') == 'True':
         logger.info("Applying PCA...")
-        reduced_data = apply_pca(valid_vectors_df)
+        reducer = fit_reducer(vectors)
+        reduced_data = reducer.transform(vectors)
     
         logger.info("Performing HDBSCAN clustering...")
         labels, clusterer = perform_clustering_hdbscan(reduced_data, float(os.getenv('SIMILARITY_THRESHOLD')), int(os.getenv('MIN_CLUSTER_SIZE')), int(os.getenv('MIN_SAMPLES')))
-        # Add the cluster labels to the original DataFrame
-        valid_vectors_df['cluster'] = labels
+        save_clustering_model(reducer, clusterer)
     else:
-        valid_vectors_df = perform_clustering_dbscan(valid_vectors_df, float(os.getenv('SIMILARITY_THRESHOLD')), int(os.getenv('MIN_SAMPLES')))
+        labels = perform_clustering_dbscan(vectors, float(os.getenv('SIMILARITY_THRESHOLD')), int(os.getenv('MIN_SAMPLES')))
+
+    # Add the cluster labels to the original DataFrame
+    df['cluster'] = labels
 
-    
-    # Group listings by cluster
-    cluster_groups = valid_vectors_df.groupby('cluster')['id'].apply(list).reset_index(name='listings_in_cluster')
-    
-    # Convert listings_in_cluster to text
-    cluster_groups['listings_in_cluster'] = cluster_groups['listings_in_cluster'].apply(lambda x: ','.join(map(str, x))).astype(str)
-    # Merge cluster groups back to original DataFrame if needed
-    valid_vectors_df = valid_vectors_df.merge(cluster_groups, on='cluster', how='left')
-    
     logger.info("Finished clustering process.")
 
-    return valid_vectors_df
\ No newline at end of file
+    return df
+
+def build_cluster_members(df, vectors):
+    """Return one (cluster_id, listing_id, rank) row per clustered listing, ranked by cosine
+    similarity to the cluster centroid. Noise listings (cluster -1) are left out."""
+    mask = (df['cluster'] != -1).to_numpy()
+    clustered = df[mask]
+    if clustered.empty:
+        return pd.DataFrame(columns=['cluster_id', 'listing_id', 'rank'])
+
+    vectors = vectors[mask]
+    labels = clustered['cluster'].to_numpy()
+    _, inverse = np.unique(labels, return_inverse=True)
+
+    # Unnormalized centroids are enough to rank members within a cluster
+    centroids = np.zeros((inverse.max() + 1, vectors.shape[1]))
+    np.add.at(centroids, inverse, vectors)
+    scores = np.einsum('nd,nd->n', vectors, centroids[inverse])
+
+    members = pd.DataFrame({
+        'cluster_id': labels.astype(int),
+        'listing_id': clustered['id'].to_numpy().astype(int),
+        'score': scores,
+    })
+    members = members.sort_values(['cluster_id', 'score'], ascending=[True, False], kind='stable')
+    members['rank'] = members.groupby('cluster_id').cumcount()
+    return members[['cluster_id', 'listing_id', 'rank']]
+
+def assign_clusters(neighbours, clusters, similarity_threshold):
+    """Cluster labels for listings added to an existing clustering, from their nearest neighbours.
+
+    `neighbours` maps a listing id to its (neighbour id, cosine score) pairs, best first, and
+    `clusters` the ids of already clustered listings to their label. Like a DBSCAN border
+    point, a listing joins the cluster of its most similar clustered neighbour when the
+    similarity reaches the threshold and is noise (-1) otherwise. New clusters only form on
+    a full rebuild.
+    """
+    labels = {}
+    for listing_id, candidates in neighbours.items():
+        labels[listing_id] = -1
+        for neighbour, score in candidates:
+            if score < similarity_threshold:
+                break
+            if clusters.get(neighbour, -1) != -1:
+                labels[listing_id] = clusters[neighbour]
+                break
+    return labels
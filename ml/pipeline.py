@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import os
+
+import click
+import numpy as np
+import pandas as pd
+from loguru import logger
+from dotenv import load_dotenv
+
+from ml.artifacts import write_listings, read_listings, write_embeddings, read_embeddings, default_artifacts_path
+from ml.data.make_dataset import clean_data, content_hashes, listing_statistics, read_listing_chunks
+from ml.features.build_features import add_text_features, embed_listings, EMBEDDING_FIELDS
+from ml.model.similarity_search import pipeline_clustering
+
+load_dotenv()
+
+# Every stage writes an artifact of the same name that the next stage reads
+STAGES = ['clean', 'features', 'embeddings', 'clustering']
+
+
+def load_clean_listings(input_filepath, chunksize=None):
+    """Stream the listings CSV twice, so only one raw chunk is in memory at a time: first for
+    the statistics used to fill missing values, then to clean every chunk and hash its
+    source rows."""
+    stats = listing_statistics(read_listing_chunks(input_filepath, chunksize))
+    chunks = []
+    for chunk in read_listing_chunks(input_filepath, chunksize):
+        hashes = content_hashes(chunk)
+        chunk = clean_data(chunk, stats)
+        chunk['content_hash'] = chunk['id'].map(hashes)
+        chunks.append(chunk)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def run_pipeline(input_filepath=None, start='clean', stop='clustering', path=None):
+    """Run the stages from `start` to `stop`, writing each stage's artifact.
+
+    A stage whose input wasn't produced in this run reads it from the previous stage's
+    artifact, so e.g. `start='clustering'` re-clusters without reading the CSV or embedding.
+    Returns the listings DataFrame and, once the embeddings stage ran or was read, the
+    (n, 3, d) embeddings and (n, d) average embeddings aligned with it.
+    """
+    df = embeddings = average_embeddings = None
+    for stage in STAGES[STAGES.index(start):STAGES.index(stop) + 1]:
+        logger.info(f"Running the {stage} stage.")
+        if stage == 'clean':
+            df = load_clean_listings(input_filepath or os.getenv('NYC_CSV_FILEPATH'))
+            write_listings('clean', df, path)
+        elif stage == 'features':
+            df = add_text_features(df if df is not None else read_listings('clean', path))
+            write_listings('features', df, path)
+        elif stage == 'embeddings':
+            df = df if df is not None else read_listings('features', path)
+            embeddings, average_embeddings = embed_listings(df)
+            write_embeddings(df['id'].to_numpy(), embeddings, average_embeddings, EMBEDDING_FIELDS, path)
+        elif stage == 'clustering':
+            df = df if df is not None else read_listings('features', path)
+            if embeddings is None:
+                ids, embeddings, average_embeddings = read_embeddings(EMBEDDING_FIELDS, path)
+                if not np.array_equal(ids, df['id'].to_numpy()):
+                    raise ValueError("The embeddings artifact doesn't match the features artifact, rerun from 'embeddings'")
+            df = pipeline_clustering(df, average_embeddings)
+            write_listings('clustering', df[['id', 'cluster']], path)
+    return df, embeddings, average_embeddings
+
+
+@click.command()
+@click.option("--input-filepath", default=None, help="Listings CSV, defaults to NYC_CSV_FILEPATH.")
+@click.option("--from-stage", "start", type=click.Choice(STAGES), default='clean', help="First stage to run.")
+@click.option("--to-stage", "stop", type=click.Choice(STAGES), default='clustering', help="Last stage to run.")
+def main(input_filepath, start, stop):
+    """Runs pipeline stages, each reading the previous stage's Parquet artifact."""
+    if STAGES.index(start) > STAGES.index(stop):
+        raise click.BadParameter(f"--from-stage {start} comes after --to-stage {stop}")
+    run_pipeline(input_filepath, start, stop)
+    logger.info(f"Artifacts written to {default_artifacts_path()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""Checks that the column-wise text feature builders produce exactly the text of the row
+builders, and times both.
+
+Runs on the cleaned listings CSV (NYC_CSV_FILEPATH by default) and on a synthetic frame of
+edge cases: missing values, every score bucket boundary and non-string text fields.
+"""
+import os
+import sys
+import time
+
+import click
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from ml.features.build_features import (
+    create_overview, evaluate_listing, construct_high_level_overview,
+    create_overviews, evaluate_listings, construct_high_level_overviews,
+)
+from ml.pipeline import load_clean_listings
+
+BUILDERS = [
+    ('description_summary', create_overview, create_overviews),
+    ('property_outline', evaluate_listing, evaluate_listings),
+    ('high_level_overview', construct_high_level_overview, construct_high_level_overviews),
+]
+
+SCORE_COLUMNS = [
+    'review_scores_rating', 'review_scores_cleanliness', 'review_scores_checkin',
+    'review_scores_communication', 'review_scores_location', 'review_scores_value',
+]
+
+
+def edge_cases(n=2000, seed=0):
+    rng = np.random.default_rng(seed)
+
+    def sometimes_missing(values, share=0.2):
+        values = pd.Series(values, dtype=object)
+        values[rng.random(n) < share] = np.nan
+        return values
+
+    df = pd.DataFrame({
+        'property_type': sometimes_missing(rng.choice(['Entire home', 'Room', ''], n)),
+        'room_type': rng.choice(['Entire home/apt', 'Private room'], n),
+        'neighbourhood_cleansed': rng.choice(['Harlem', 'SoHo'], n),
+        'bathrooms_text': sometimes_missing(rng.choice(['1 bath', '2.5 baths', ' '], n)),
+        'description': sometimes_missing(rng.choice(['Cozy.', '  spaced  ', 'N/A'], n)),
+        'neighborhood_overview': sometimes_missing(rng.choice(['Quiet.', 'Busy.'], n)),
+        'price': rng.choice([np.nan, 0.005, 99.995, 150.0, 1234.5], n),
+    })
+    for column in ['bedrooms', 'beds', 'accommodates']:
+        df[column] = rng.choice([np.nan, 0.0, 1.0, 2.7], n)
+    for column in SCORE_COLUMNS:
+        df[column] = rng.choice([np.nan, 0.0, 3.49, 3.5, 4.49, 4.5, 5.0], n)
+    df.loc[::7, 'description'] = 42
+    return df
+
+
+def compare(name, df):
+    print(f"{name}: {len(df)} rows")
+    for column, row_builder, column_builder in BUILDERS:
+        start = time.perf_counter()
+        expected = df.apply(row_builder, axis=1)
+        row_s = time.perf_counter() - start
+
+        start = time.perf_counter()
+        actual = column_builder(df)
+        column_s = time.perf_counter() - start
+
+        mismatches = int((expected.to_numpy() != actual.to_numpy()).sum())
+        print(f"  {column:<22} row-wise {row_s:7.2f}s  column-wise {column_s:6.2f}s  "
+              f"{row_s / column_s:5.1f}x  mismatches {mismatches}")
+        if mismatches:
+            first = np.flatnonzero(expected.to_numpy() != actual.to_numpy())[0]
+            raise SystemExit(f"    row {first}: {expected.iloc[first]!r} != {actual.iloc[first]!r}")
+
+
+@click.command()
+@click.option("--input-filepath", default=os.getenv('NYC_CSV_FILEPATH'), help="Raw listings CSV.")
+def main(input_filepath):
+    compare('edge cases', edge_cases())
+    if input_filepath and os.path.exists(input_filepath):
+        compare(input_filepath, load_clean_listings(input_filepath))
+
+
+if __name__ == "__main__":
+    main()
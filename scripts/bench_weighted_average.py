@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""Compares the per-row weighted average embedding with the vectorized one.
+
+The row-wise baseline is timed on at most --rowwise-limit rows and extrapolated, since it
+takes minutes at 500k rows.
+"""
+import os
+import sys
+import time
+
+import click
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from ml.features.build_features import apply_weighted_average, weighted_average_embedding, DEFAULT_EMBEDDING_WEIGHTS
+
+
+def random_embeddings(n, dim, seed=0):
+    rng = np.random.default_rng(seed)
+    embeddings = rng.standard_normal((n, 3, dim), dtype=np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=2, keepdims=True)
+    return embeddings
+
+
+@click.command()
+@click.option("--sizes", default="50000,500000", help="Comma separated row counts.")
+@click.option("--dim", default=768, help="Embedding dimension.")
+@click.option("--rowwise-limit", default=50000, help="Rows the row-wise baseline is timed on.")
+def main(sizes, dim, rowwise_limit):
+    weights = DEFAULT_EMBEDDING_WEIGHTS
+    print(f"{'rows':>8} {'row-wise s':>12} {'vectorized s':>13} {'speedup':>8}")
+    for n in [int(size) for size in sizes.split(',')]:
+        embeddings = random_embeddings(n, dim)
+
+        start = time.perf_counter()
+        vectorized = apply_weighted_average(embeddings, weights)
+        vectorized_s = time.perf_counter() - start
+
+        sample = min(n, rowwise_limit)
+        start = time.perf_counter()
+        rowwise = np.stack([weighted_average_embedding(list(row), weights) for row in embeddings[:sample]])
+        rowwise_s = (time.perf_counter() - start) * n / sample
+
+        assert np.allclose(rowwise, vectorized[:sample], atol=1e-5)
+        estimate = '~' if sample < n else ' '
+        print(f"{n:>8} {estimate}{rowwise_s:>11.2f} {vectorized_s:>13.3f} {rowwise_s / vectorized_s:>7.0f}x")
+        del embeddings, vectorized, rowwise
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""Measures API throughput as the number of concurrent clients grows.
+
+With the routes awaiting the database executor, requests per second should keep rising
+with concurrency up to roughly DB_EXECUTOR_WORKERS instead of staying flat at single
+query speed.
+"""
+import os
+import time
+import random
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+import requests
+from dotenv import load_dotenv
+from loguru import logger
+
+load_dotenv()
+
+
+def sample_listing_ids(db_path, n):
+    """Samples ids from the database, or from every market it lists when it is a market index."""
+    conn = sqlite3.connect(db_path)
+    try:
+        is_index = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'market'"
+        ).fetchone()
+        if is_index:
+            market_paths = [row[0] for row in conn.execute("SELECT db_path FROM market ORDER BY name")]
+        else:
+            rows = conn.execute("SELECT id FROM listing ORDER BY random() LIMIT ?", (n,)).fetchall()
+    finally:
+        conn.close()
+    if is_index:
+        ids = [id for path in market_paths for id in sample_listing_ids(path, n)]
+        return random.sample(ids, min(n, len(ids)))
+    return [row[0] for row in rows]
+
+
+def run_level(base_url, path, listing_ids, concurrency, requests_per_client):
+    """Returns (requests per second, p50 ms, p99 ms, errors) for one concurrency level."""
+    def client(_):
+        session = requests.Session()
+        latencies, errors = [], 0
+        for _ in range(requests_per_client):
+            url = base_url + path.format(id=random.choice(listing_ids))
+            start = time.perf_counter()
+            response = session.get(url)
+            latencies.append(time.perf_counter() - start)
+            errors += response.status_code >= 500
+        return latencies, errors
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(client, range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(l for latencies, _ in results for l in latencies)
+    errors = sum(e for _, e in results)
+    p50 = latencies[len(latencies) // 2] * 1000
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000
+    return len(latencies) / elapsed, p50, p99, errors
+
+
+@click.command()
+@click.option("--base-url", default="http://localhost:8080/api/v1")
+@click.option("--path", default="/listing/{id}", help="Route to hit, {id} is replaced by a listing id.")
+@click.option("--db-path", default=os.getenv('DB_PATH'), type=click.Path(exists=True))
+@click.option("--concurrency", default="1,2,4,8,16,32", help="Comma separated client counts.")
+@click.option("--requests-per-client", default=200)
+def main(base_url, path, db_path, concurrency, requests_per_client):
+    """Runs the load test against a running service (`make run`)."""
+    listing_ids = sample_listing_ids(db_path, 1000)
+    logger.info(f"Sampled {len(listing_ids)} listing ids from {db_path}")
+
+    print(f"{'clients':>8} {'req/s':>10} {'p50 ms':>10} {'p99 ms':>10} {'5xx':>6}")
+    for level in [int(c) for c in concurrency.split(',')]:
+        rps, p50, p99, errors = run_level(base_url, path, listing_ids, level, requests_per_client)
+        print(f"{level:>8} {rps:>10.1f} {p50:>10.2f} {p99:>10.2f} {errors:>6}")
+
+
+if __name__ == "__main__":
+    main()